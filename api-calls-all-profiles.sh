@@ -92,12 +92,20 @@ if [ $? -eq 0 ]; then
         
         # Extract important info
         MESSAGE=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('message', 'Unknown response'))" 2>/dev/null)
-        BATCH_ID=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('batch_id', 'N/A'))" 2>/dev/null)
+        BATCH_ID=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('batch_id') or 'N/A')" 2>/dev/null)
+        # Profiles already running in an overlapping batch are joined, so wait for those batches too
+        BATCH_IDS=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(' '.join(data.get('batch_ids', [])))" 2>/dev/null)
         PROFILES_COUNT=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('profiles_count', 0))" 2>/dev/null)
         
+        DEAD_LETTER=$(echo "$RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print('\n'.join(f\"{entry['profile']}: {entry['reason']}\" for entry in data.get('dead_letter', [])))" 2>/dev/null)
+        
         print_success "$MESSAGE"
         print_status "Batch ID: $BATCH_ID"
         print_status "Profiles processed: $PROFILES_COUNT"
+        if [ -n "$DEAD_LETTER" ]; then
+            print_warning "Profiles that failed the token pre-flight:"
+            echo "$DEAD_LETTER"
+        fi
     else
         print_error "Response is not valid JSON:"
         echo "$RESPONSE"
@@ -109,95 +117,45 @@ else
 fi
 echo ""
 
-# Step 3: GET /status - Wait until all tasks complete
-print_status "Step 3: Monitoring all profile tasks execution..."
-TASK_CHECK_COUNT=0
-while true; do
-    TASK_CHECK_COUNT=$((TASK_CHECK_COUNT + 1))
-    STATUS_RESPONSE=$(curl -s "$SERVER_URL/status?password=$PASSWORD")
-    if [ $? -eq 0 ] && echo "$STATUS_RESPONSE" | python3 -m json.tool >/dev/null 2>&1; then
-        print_status "--- Task Status Check #$TASK_CHECK_COUNT ---"
-        echo "$STATUS_RESPONSE" | python3 -m json.tool
-        
-        # Extract detailed information
-        IS_BUSY=$(echo "$STATUS_RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('is_busy', 'false'))" 2>/dev/null)
-        RUNNING_TASKS=$(echo "$STATUS_RESPONSE" | python3 -c "import sys, json; data=json.load(sys.stdin); print(data.get('running_tasks', 0))" 2>/dev/null)
-        
-        # Display task history details
-        TASK_HISTORY=$(echo "$STATUS_RESPONSE" | python3 -c "
+# Step 3: GET /batches/<batch_id>/wait - Wait until all tasks complete
+for BATCH_ID in $BATCH_IDS; do
+    print_status "Step 3: Waiting for all profile tasks of batch $BATCH_ID..."
+    WAIT_COUNT=0
+    while true; do
+        WAIT_COUNT=$((WAIT_COUNT + 1))
+        # The server holds the request until the batch is done or the timeout expires
+        WAIT_RESPONSE=$(curl -s "$SERVER_URL/batches/$BATCH_ID/wait?password=$PASSWORD&timeout=60")
+        BATCH_STATE=$(echo "$WAIT_RESPONSE" | python3 -c "
 import sys, json
 data = json.load(sys.stdin)
-history = data.get('task_history', [])
-if history:
-    print('\n📋 Task History Details:')
-    for i, task in enumerate(history[-5:], 1):  # Show last 5 tasks
-        print(f'  {i}. Task ID: {task.get(\"task_id\", \"N/A\")} | Status: {task.get(\"status\", \"N/A\")} | Time: {task.get(\"timestamp\", \"N/A\")}')
-    
-    # Check for incomplete tasks (started but not completed/failed)
-    incomplete_tasks = []
-    task_ids = set()
-    for task in history:
-        task_id = task.get('task_id')
-        status = task.get('status')
-        if task_id and status == 'started':
-            has_completion = any(t.get('task_id') == task_id and t.get('status') in ['completed', 'failed'] for t in history)
-            if not has_completion:
-                incomplete_tasks.append(task_id)
-    
-    if incomplete_tasks:
-        print(f'⚠️  Found {len(incomplete_tasks)} incomplete task(s): {", ".join(incomplete_tasks)}')
-else:
-    print('\n📋 No task history available')
+print(str(data.get('done', False)).lower(), data.get('pending', 0))
+for task in data.get('tasks', []):
+    print(f'  Task ID: {task.get(\"task_id\", \"N/A\")} | Status: {task.get(\"status\", \"N/A\")} | Finished: {task.get(\"finished_at\") or \"-\"}')
 " 2>/dev/null)
-        
-        if [ -n "$TASK_HISTORY" ]; then
-            echo "$TASK_HISTORY"
+
+        if [ -z "$BATCH_STATE" ]; then
+            print_error "Failed to get batch status or invalid response:"
+            echo "$WAIT_RESPONSE"
+            break
         fi
-        
-        # Check for incomplete tasks
-        INCOMPLETE_COUNT=$(echo "$STATUS_RESPONSE" | python3 -c "
-import sys, json
-try:
-    data = json.load(sys.stdin)
-    history = data.get('task_history', [])
-    incomplete_tasks = []
-    for task in history:
-        task_id = task.get('task_id')
-        status = task.get('status')
-        if task_id and status == 'started':
-            has_completion = any(t.get('task_id') == task_id and t.get('status') in ['completed', 'failed'] for t in history)
-            if not has_completion:
-                incomplete_tasks.append(task_id)
-    print(len(incomplete_tasks))
-except:
-    print(0)
-" 2>/dev/null || echo 0)
-        
-        if [ "$IS_BUSY" = "true" ] || [ "$INCOMPLETE_COUNT" -gt 0 ]; then
-            if [ "$IS_BUSY" = "true" ]; then
-                print_warning "⚠️  Server is BUSY - $RUNNING_TASKS task(s) still running. Waiting..."
-            fi
-            if [ "$INCOMPLETE_COUNT" -gt 0 ]; then
-                print_warning "⚠️  Found $INCOMPLETE_COUNT incomplete task(s) in history. Waiting..."
-            fi
-            print_status "Checking again in 5 seconds..."
-            sleep 5
-        else
-            print_success "✅ Server is FREE - All profile tasks completed successfully!"
-            print_status "Total status checks performed: $TASK_CHECK_COUNT"
+
+        read -r DONE PENDING <<< "$(echo "$BATCH_STATE" | head -n 1)"
+        print_status "--- Batch Status Check #$WAIT_COUNT ---"
+        echo "$BATCH_STATE" | tail -n +2
+
+        if [ "$DONE" = "true" ]; then
+            print_success "✅ All profile tasks of batch $BATCH_ID finished!"
+            print_status "Total status checks performed: $WAIT_COUNT"
             break
         fi
-    else
-        print_error "Failed to get status or invalid response:"
-        echo "$STATUS_RESPONSE"
-        break
-    fi
+        print_warning "⚠️  $PENDING task(s) still pending. Waiting..."
+    done
 done
 echo ""
 
-# Step 4: GET /logs - Get full logs
-print_status "Step 4: Getting full execution logs..."
-LOG_RESPONSE=$(curl -s "$SERVER_URL/logs?password=$PASSWORD")
+# Step 4: GET /logs - Get the latest logs
+print_status "Step 4: Getting latest execution logs..."
+LOG_RESPONSE=$(curl -s "$SERVER_URL/logs?password=$PASSWORD&tail=500")
 if [ $? -eq 0 ] && [ -n "$LOG_RESPONSE" ]; then
     echo "$LOG_RESPONSE"
 else
@@ -1,10 +1,26 @@
 from uvicorn import run
 from quart import Quart, request, redirect
-from httpx import AsyncClient as httpx_client
-from sys import argv, exit as sys_exit
+from httpx import AsyncClient as httpx_client, Limits
+from argparse import ArgumentParser
+from urllib.parse import urlencode
 from webbrowser import open as open_link
 from logging import getLogger
-from config import LOGGER_CONFIG_JSON
+from html import escape
+from config import LOGGER_CONFIG_JSON, PROFILE_STORE, PROFILES_FILE, PROFILE_DB_FILE
+import asyncio
+import json
+import secrets
+import time
+
+"""
+Onboards accounts for the renewal server.
+Every sign-in gets its own state value, so several consent flows (one per browser window or account)
+can run at the same time. Codes are redeemed as they arrive and the refresh tokens are merged into
+the profile store. Tokens and secrets are only ever written there, never printed or shown.
+
+    python auth.py YourClientID YourClientSecret
+    python auth.py --apps apps.json
+"""
 
 class WebServer:
     instance = Quart(__name__)
@@ -39,6 +55,7 @@ class WebServer:
 
         @self.instance.after_serving
         async def after_serve():
+            await HTTPClient.close()
             self.logger.info('Server is not stopped!')
 
         ErrorHandler(self.instance)
@@ -81,37 +98,151 @@ class ErrorHandler:
     def abort(cls, status_code: int = 500, description: str = None):
         raise HTTPError(status_code, description)
 
+class Onboarding:
+    # App registrations as {'client_id', 'client_secret'}, set from the command line
+    apps = []
+    # Sign-ins waiting for their redirect, state -> (app index, started)
+    _pending = {}
+    state_ttl = 600
+    _accounts = []
+
+    @classmethod
+    def load_apps(cls, credentials: list, apps_file: str = None) -> list:
+        """App registrations from client ID and secret pairs and/or a JSON file listing them"""
+        apps = [
+            {'client_id': client_id, 'client_secret': client_secret}
+            for client_id, client_secret in zip(credentials[::2], credentials[1::2])
+        ]
+        if apps_file:
+            with open(apps_file, 'r', encoding='utf-8') as f:
+                apps += [
+                    {'client_id': app['client_id'], 'client_secret': app['client_secret']}
+                    for app in json.load(f)
+                ]
+        return apps
+
+    @classmethod
+    def start(cls, app_index: int) -> str:
+        """Authorization URL of a new sign-in with the given app"""
+        now = time.monotonic()
+        for state, (_, started) in list(cls._pending.items()):
+            if now - started > cls.state_ttl:
+                del cls._pending[state]
+
+        state = secrets.token_urlsafe(16)
+        cls._pending[state] = (app_index, now)
+        query = urlencode({
+            'client_id': cls.apps[app_index]['client_id'],
+            'response_type': 'code',
+            'redirect_uri': WebServer.auth_redirect_url,
+            'scope': ' '.join(WebServer.scopes),
+            'state': state,
+            # Lets the operator pick another account than the one signed in to the browser
+            'prompt': 'select_account'
+        })
+        return f'{WebServer.auth_endpoint}?{query}'
+
+    @classmethod
+    def take(cls, state: str):
+        """App of a pending sign-in, each state is redeemed once"""
+        app_index, started = cls._pending.pop(state, (None, 0))
+        if app_index is None or time.monotonic() - started > cls.state_ttl:
+            return None
+        return cls.apps[app_index]
+
+    @classmethod
+    async def save(cls, profile: dict) -> dict:
+        """Merge the account into the profile store, the running server picks it up on its next reload"""
+        # Imported here so showing --help does not load the renewal server
+        from main import ProfileStore
+        result = await asyncio.to_thread(ProfileStore.merge, [profile])
+        cls._accounts.append({
+            'name': profile['name'],
+            'client_id': profile['client_id'][:8] + '...',
+            'status': 'added' if result['added'] else 'updated'
+        })
+        return result
+
 class RouteHandler:
     def __init__(
         self,
         instance: Quart,
     ):
-        self.authorization_url = (
-            f'{WebServer.auth_endpoint}'
-            f'?client_id={argv[1]}'
-            '&response_type=code'
-            f'&redirect_uri={WebServer.auth_redirect_url}'
-            f'&scope={"+".join(WebServer.scopes)}'
-        )
         @instance.route('/')
         async def root():
             code = request.args.get('code')
-
             if code:
-                return (await HTTPClient.redeem_auth_code(code)), 200
+                return await self.complete(code, request.args.get('state'))
+            if request.args.get('error'):
+                return escape(request.args.get('error_description') or request.args['error']), 400
+
+            # A single app keeps the old behaviour of going straight to the sign-in
+            if len(Onboarding.apps) == 1 and not Onboarding._accounts:
+                return redirect(Onboarding.start(0))
+            return self.render_index(), 200
+
+        @instance.route('/login/<int:app_index>')
+        async def login(app_index: int):
+            if app_index >= len(Onboarding.apps):
+                ErrorHandler.abort(400, 'Unknown app registration.')
+            return redirect(Onboarding.start(app_index))
+
+    async def complete(self, code: str, state: str):
+        app = Onboarding.take(state) if state else None
+        if app is None:
+            ErrorHandler.abort(400, 'Unknown or expired sign-in, start again from the <a href="/">start page</a>.')
 
-            return redirect(self.authorization_url)
+        token_response = await HTTPClient.redeem_auth_code(code, app['client_id'], app['client_secret'])
+        if not token_response.get('refresh_token'):
+            # Microsoft's error descriptions never contain the code or the secret
+            ErrorHandler.abort(400, escape(token_response.get('error_description') or 'No refresh token was issued.'))
+
+        name = await HTTPClient.get_account_name(token_response['access_token'])
+        if not name:
+            ErrorHandler.abort(400, 'Could not read the signed in account.')
+        result = await Onboarding.save({
+            'name': name,
+            'client_id': app['client_id'],
+            'client_secret': app['client_secret'],
+            'refresh_token': token_response['refresh_token'],
+            'enabled': True
+        })
+        target = PROFILE_DB_FILE if PROFILE_STORE == 'sqlite' else PROFILES_FILE
+        getLogger('uvicorn').info(f"Profile {'added' if result['added'] else 'updated'}: {name}")
+        return (
+            f"<p>{escape(name)} was {'added to' if result['added'] else 'updated in'} {escape(str(target))}. "
+            'You can close this tab or <a href="/">add another account</a>.</p>'
+        ), 200
+
+    def render_index(self) -> str:
+        rows = ''.join(
+            f"<li>{escape(app['client_id'][:8])}... <a href=\"/login/{index}\" target=\"_blank\">Add an account</a></li>"
+            for index, app in enumerate(Onboarding.apps)
+        )
+        accounts = ''.join(
+            f"<li>{escape(account['name'])} ({escape(account['client_id'])}) {account['status']}</li>"
+            for account in Onboarding._accounts
+        )
+        return (
+            '<h3>App registrations</h3>'
+            '<p>Every link starts its own sign-in, open as many as needed at once '
+            '(use private windows to stay signed in to several accounts).</p>'
+            f'<ul>{rows}</ul>'
+            f"<h3>Onboarded accounts</h3><ul>{accounts or '<li>None yet</li>'}</ul>"
+        )
 
 class HTTPClient:
-    instance = httpx_client()
+    # Pooled so concurrent redemptions reuse connections to login.microsoftonline.com
+    instance = httpx_client(limits=Limits(max_connections=20, max_keepalive_connections=10))
     token_url = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+    me_url = 'https://graph.microsoft.com/v1.0/me?$select=userPrincipalName,mail'
 
     @classmethod
     async def redeem_auth_code(
         cls,
         code: str,
-        client_id: str = argv[1],
-        client_secret: str = argv[2]
+        client_id: str,
+        client_secret: str
     ):
         data = {
             'grant_type': 'authorization_code',
@@ -123,16 +254,34 @@ class HTTPClient:
 
         return (await cls.instance.post(cls.token_url, data=data)).json()
 
+    @classmethod
+    async def get_account_name(cls, access_token: str):
+        """Sign-in name of the account, used as the profile name"""
+        response = await cls.instance.get(cls.me_url, headers={'Authorization': f'Bearer {access_token}'})
+        if response.status_code != 200:
+            return None
+        me = response.json()
+        return me.get('userPrincipalName') or me.get('mail')
+
+    @classmethod
+    async def close(cls):
+        await cls.instance.aclose()
+
 web_server = WebServer().instance
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description='Onboard accounts into the profile store')
+    parser.add_argument('credentials', nargs='*', help='client ID and secret pairs of app registrations')
+    parser.add_argument('--apps', help='JSON file with a list of {"client_id": ..., "client_secret": ...} objects')
+    arguments = parser.parse_args()
 
-    if len(argv) < 3:
-        print('Error: You must pass both the client ID and secret as command line arguments.')
-        sys_exit(1)
+    if len(arguments.credentials) % 2 or not (arguments.credentials or arguments.apps):
+        parser.error('pass client ID and secret pairs and/or --apps')
+    Onboarding.apps = Onboarding.load_apps(arguments.credentials, arguments.apps)
 
+    # Served by object, importing the module again by name would drop the apps set above
     run(
-        app='auth:web_server',
+        app=web_server,
         host="0.0.0.0",
         port=53682,
         log_config=LOGGER_CONFIG_JSON,
@@ -0,0 +1,298 @@
+from argparse import ArgumentParser, SUPPRESS
+from datetime import datetime
+from statistics import quantiles
+from pathlib import Path
+import subprocess
+import tempfile
+import asyncio
+import json
+import os
+import sys
+import time
+
+"""
+Offline throughput benchmark.
+Starts mock_graph.py in place of login.microsoftonline.com, graph.microsoft.com and api.powerbi.com,
+then drives the profile sweep, /call-all-profiles and /call for synthetic profiles. Every scenario runs
+in a fresh process so peak memory and open sockets are measured per run.
+
+    python benchmark.py --profiles 10,100,1000 --latency-ms 50 --throttle-rate 0.01
+"""
+
+PASSWORD = 'benchmark'
+
+class Benchmark:
+    scenarios = ['sweep', 'call-all-profiles', 'call']
+    mock_port = 9997
+
+    @classmethod
+    def write_profiles(cls, path: Path, count: int):
+        # Ten accounts per app registration, like a fleet of a few tenants with many users each
+        profiles = [
+            {
+                'name': f'bench{index}@example.com',
+                'client_id': f'bench-app-{index // 10}',
+                'client_secret': 'secret',
+                'refresh_token': f'refresh-{index}',
+                'enabled': True
+            }
+            for index in range(count)
+        ]
+        path.write_text(json.dumps({'profiles': profiles}), encoding='utf-8')
+
+    @classmethod
+    def get_environment(cls, directory: Path, count: int) -> dict:
+        return {
+            **os.environ,
+            'E5_UPSTREAM_BASE_URL': f'http://127.0.0.1:{cls.mock_port}',
+            'E5_WEB_APP_PASSWORD': PASSWORD,
+            # Unpaced, so results show the server's own overhead rather than the per-tenant rate limit
+            'E5_RATE_LIMIT_MODE': 'fixed',
+            'E5_TIME_DELAY': '0',
+            'E5_UPLOAD_LOGS_TO_ONEDRIVE': 'false',
+            'E5_SCHEDULE_ENABLED': 'false',
+            'E5_JOB_QUEUE_SIZE': str(max(1000, count)),
+            'E5_PROFILES_FILE': str(directory / 'profiles.json'),
+            'E5_PROFILE_STORE': 'json',
+            'E5_TASK_DB_FILE': str(directory / 'tasks.db'),
+            'E5_TOKEN_CACHE_FILE': str(directory / 'token-cache.json'),
+            'E5_ENDPOINT_PLAN_FILE': str(directory / 'endpoint-plan.json'),
+            'E5_LOG_UPLOAD_STATE_FILE': str(directory / 'log-upload-state.json'),
+            'E5_LOG_FILE': str(directory / 'event-log.txt')
+        }
+
+    @classmethod
+    def start_mock(cls, arguments, environment: dict):
+        process = subprocess.Popen(
+            [
+                sys.executable, 'mock_graph.py', str(cls.mock_port),
+                '--latency-ms', str(arguments.latency_ms),
+                '--error-rate', str(arguments.error_rate),
+                '--throttle-rate', str(arguments.throttle_rate),
+                '--retry-after', str(arguments.retry_after)
+            ],
+            cwd=Path(__file__).parent,
+            env=environment,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        import httpx
+        for _ in range(100):
+            try:
+                httpx.get(f'http://127.0.0.1:{cls.mock_port}/stats', timeout=1)
+                return process
+            except httpx.TransportError:
+                time.sleep(0.1)
+        process.terminate()
+        raise RuntimeError('Mock server did not start')
+
+    @classmethod
+    def run_scenario(cls, scenario: str, count: int, environment: dict) -> dict:
+        """Run one scenario in a child process and return the result it prints"""
+        completed = subprocess.run(
+            [sys.executable, __file__, '--worker', scenario, '--profiles', str(count)],
+            cwd=Path(__file__).parent,
+            env=environment,
+            capture_output=True,
+            text=True
+        )
+        if completed.returncode != 0:
+            return {'scenario': scenario, 'profiles': count, 'error': completed.stderr.strip().splitlines()[-1:]}
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    @classmethod
+    def compare(cls, results: list, baseline_path: str):
+        """Print the change of every metric against a previous result file"""
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = {(entry['scenario'], entry['profiles']): entry for entry in json.load(f)['results']}
+        for result in results:
+            previous = baseline.get((result['scenario'], result['profiles']))
+            if not previous or 'error' in result or 'error' in previous:
+                continue
+            changes = []
+            for metric in ('profiles_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'peak_open_sockets'):
+                if result.get(metric) is not None and previous.get(metric):
+                    changes.append(f'{metric} {(result[metric] - previous[metric]) / previous[metric] * 100:+.1f}%')
+            print(f"{result['scenario']:>18} {result['profiles']:>5}: {', '.join(changes)}")
+
+    @classmethod
+    def main(cls):
+        parser = ArgumentParser(description='Offline throughput benchmark against mock_graph.py')
+        parser.add_argument('--profiles', default='10,100,1000', help='comma separated profile counts')
+        parser.add_argument('--scenarios', default=','.join(cls.scenarios), help='comma separated scenarios')
+        parser.add_argument('--latency-ms', type=float, default=20.0)
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--throttle-rate', type=float, default=0.0)
+        parser.add_argument('--retry-after', type=int, default=1)
+        parser.add_argument('--output', default=f"benchmark-{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        parser.add_argument('--baseline', help='previous result file to compare against')
+        parser.add_argument('--worker', help=SUPPRESS)
+        arguments = parser.parse_args()
+
+        if arguments.worker:
+            result = asyncio.run(BenchmarkWorker.run(arguments.worker, int(arguments.profiles)))
+            print(json.dumps(result))
+            return 0
+
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            mock = cls.start_mock(arguments, cls.get_environment(Path(directory), 0))
+            try:
+                for count in map(int, arguments.profiles.split(',')):
+                    for scenario in arguments.scenarios.split(','):
+                        # Fresh state per run, a warm token cache or task store would flatter later runs
+                        run_directory = Path(tempfile.mkdtemp(dir=directory))
+                        cls.write_profiles(run_directory / 'profiles.json', count)
+                        result = cls.run_scenario(scenario, count, cls.get_environment(run_directory, count))
+                        results.append(result)
+                        print(json.dumps(result))
+            finally:
+                mock.terminate()
+                mock.wait()
+
+        report = {
+            'started_at': datetime.now().isoformat(),
+            'mock': {
+                'latency_ms': arguments.latency_ms,
+                'error_rate': arguments.error_rate,
+                'throttle_rate': arguments.throttle_rate,
+                'retry_after': arguments.retry_after
+            },
+            'results': results
+        }
+        with open(arguments.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved to {arguments.output}')
+
+        if arguments.baseline:
+            cls.compare(results, arguments.baseline)
+        return 1 if any('error' in result for result in results) else 0
+
+class BenchmarkWorker:
+    _peak_sockets = 0
+
+    @classmethod
+    def count_sockets(cls):
+        """Open sockets of this process, None where /proc is not available"""
+        try:
+            descriptors = os.listdir('/proc/self/fd')
+        except OSError:
+            return None
+        sockets = 0
+        for descriptor in descriptors:
+            try:
+                sockets += os.readlink(f'/proc/self/fd/{descriptor}').startswith('socket:')
+            except OSError:
+                pass
+        return sockets
+
+    @classmethod
+    async def sample_sockets(cls):
+        while True:
+            sockets = cls.count_sockets()
+            if sockets is None:
+                return
+            cls._peak_sockets = max(cls._peak_sockets, sockets)
+            await asyncio.sleep(0.05)
+
+    @classmethod
+    def get_peak_rss_mb(cls):
+        try:
+            import resource
+        except ImportError:
+            return None
+        # Kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+    @classmethod
+    def get_task_durations(cls, main, task_ids: list) -> list:
+        durations = []
+        for task_id in task_ids:
+            task = main.TaskStore.get_task(main.TaskManager._encrypt_task_id(task_id), 0, 0)
+            if task and task['status'] == 'completed' and task['started_at'] and task['finished_at']:
+                started = datetime.fromisoformat(task['started_at'])
+                durations.append((datetime.fromisoformat(task['finished_at']) - started).total_seconds())
+        return durations
+
+    @classmethod
+    async def run_sweep(cls, main) -> tuple:
+        profiles = main.ProfileStore.get_enabled()
+        batch_id = 'sweep'
+        task_ids = [f"{batch_id}-{profile['name']}" for profile in profiles]
+        main.WorkerPool.start()
+        for profile, task_id in zip(profiles, task_ids):
+            main.TaskManager.queue_task(task_id)
+            main.WorkerPool.submit(main.HTTPClient.call_endpoints_for_profile, profile, task_id)
+        await main.WorkerPool.join()
+        await main.WorkerPool.stop()
+        return task_ids, []
+
+    @classmethod
+    async def run_call_all_profiles(cls, main, client) -> tuple:
+        started = time.perf_counter()
+        response = await client.post('/call-all-profiles', json={'password': PASSWORD})
+        request_latency = time.perf_counter() - started
+        batch = await response.get_json()
+        while True:
+            response = await client.get(f"/batches/{batch['batch_id']}/wait?password={PASSWORD}&timeout=60")
+            if (await response.get_json())['done']:
+                break
+        # Task ids in responses are hashed, the store lookup needs the raw ones
+        return [f"{batch['batch_id']}-{profile['name']}" for profile in main.ProfileStore.get_enabled()], [request_latency]
+
+    @classmethod
+    async def run_call(cls, main, client) -> tuple:
+        async def call(profile):
+            started = time.perf_counter()
+            response = await client.post('/call', json={'password': PASSWORD, 'profile': profile['name']})
+            return (await response.get_json())['task_id'], time.perf_counter() - started
+
+        calls = await asyncio.gather(*(call(profile) for profile in main.ProfileStore.get_enabled()))
+        await main.WorkerPool.join()
+        return [task_id for task_id, _ in calls], [latency for _, latency in calls]
+
+    @classmethod
+    async def run(cls, scenario: str, count: int) -> dict:
+        sys.path.insert(0, str(Path(__file__).parent))
+        import main
+
+        sampler = asyncio.create_task(cls.sample_sockets())
+        started = time.perf_counter()
+        if scenario == 'sweep':
+            task_ids, request_latencies = await cls.run_sweep(main)
+        else:
+            app = main.web_server
+            async with app.test_app() as test_app:
+                client = test_app.test_client()
+                if scenario == 'call-all-profiles':
+                    task_ids, request_latencies = await cls.run_call_all_profiles(main, client)
+                else:
+                    task_ids, request_latencies = await cls.run_call(main, client)
+        duration = time.perf_counter() - started
+        sampler.cancel()
+
+        durations = cls.get_task_durations(main, task_ids)
+        percentiles = quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+        request_percentiles = (
+            quantiles(request_latencies, n=100, method='inclusive') if len(request_latencies) > 1 else request_latencies * 99
+        )
+        return {
+            'scenario': scenario,
+            'profiles': count,
+            'completed': len(durations),
+            'failed': count - len(durations),
+            'duration_seconds': round(duration, 3),
+            'profiles_per_sec': round(count / duration, 2),
+            'p50_ms': round(percentiles[49] * 1000, 1) if percentiles else None,
+            'p99_ms': round(percentiles[98] * 1000, 1) if percentiles else None,
+            'request_p50_ms': round(request_percentiles[49] * 1000, 1) if request_percentiles else None,
+            'request_p99_ms': round(request_percentiles[98] * 1000, 1) if request_percentiles else None,
+            'peak_rss_mb': cls.get_peak_rss_mb(),
+            'peak_open_sockets': cls._peak_sockets if cls.count_sockets() is not None else None,
+            'retries': main.RetryPolicy.get_stats(),
+            'token_cache': main.TokenCache.get_stats()
+        }
+
+if __name__ == '__main__':
+    sys.exit(Benchmark.main())
@@ -45,16 +45,24 @@ check_status() {
 # Function to wait for tasks to complete
 wait_for_completion() {
     echo "Waiting for all tasks to complete..."
-    
-    while true; do
-        check_status
-        if [ $? -eq 0 ]; then
-            echo "✅ All tasks completed!"
-            break
-        fi
-        
-        echo "⏳ Still waiting... (checking again in 5 seconds)"
-        sleep 5
+
+    check_status >/dev/null
+    if [ $? -eq 0 ]; then
+        echo "✅ All tasks completed!"
+        return 0
+    fi
+
+    # Follow the server's event stream instead of polling /status
+    curl -sN "${BASE_URL}/status/stream?password=${E5_WEB_APP_PASSWORD}" | while read -r line; do
+        case "$line" in
+            data:*)
+                echo "${line#data: }" | jq -c '{task_id, status, running_tasks, is_busy}'
+                if [ "$(echo "${line#data: }" | jq -r '.is_busy')" = "false" ]; then
+                    echo "✅ All tasks completed!"
+                    break
+                fi
+                ;;
+        esac
     done
 }
 
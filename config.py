@@ -1,6 +1,5 @@
 from os import environ as env
 from dotenv import load_dotenv
-import json
 from pathlib import Path
 
 # Load .env file
@@ -16,41 +15,129 @@ REFRESH_TOKEN = env.get("E5_REFRESH_TOKEN")
 CLIENT_ID = env.get("E5_CLIENT_ID")
 CLIENT_SECRET = env.get("E5_CLIENT_SECRET")
 
-# Multi-profile support
-def load_profiles():
-    """Load profiles from profiles.json file"""
-    profiles_file = Path(__file__).parent / "profiles.json"
-    if profiles_file.exists():
-        try:
-            with open(profiles_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return [profile for profile in data.get('profiles', []) if profile.get('enabled', True)]
-        except (json.JSONDecodeError, FileNotFoundError, KeyError) as e:
-            print(f"Error loading profiles: {e}")
-            return []
-    return []
-
-# Load all enabled profiles
-PROFILES = load_profiles()
-
-# If no profiles found, create default profile from env vars
-if not PROFILES and (CLIENT_ID and CLIENT_SECRET and REFRESH_TOKEN):
-    PROFILES = [{
-        'name': 'default',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET,
-        'refresh_token': REFRESH_TOKEN,
-        'enabled': True
-    }]
+# Multi-profile support, profiles are read by the profile store in main.py and reloaded when they change
+# "json" watches PROFILES_FILE, "sqlite" keeps profiles in PROFILE_DB_FILE (imported from PROFILES_FILE on first start)
+PROFILE_STORE = env.get("E5_PROFILE_STORE", "json").lower()
+PROFILES_FILE = env.get("E5_PROFILES_FILE", str(Path(__file__).parent / "profiles.json"))
+PROFILE_DB_FILE = env.get("E5_PROFILE_DB_FILE", "profiles.db")
+PROFILE_RELOAD_INTERVAL = float(env.get("E5_PROFILE_RELOAD_INTERVAL", 2))
+
 WEB_APP_PASSWORD = env.get("E5_WEB_APP_PASSWORD")
 WEB_APP_HOST = env.get("E5_WEB_APP_HOST", "0.0.0.0")
 WEB_APP_PORT = int(env.get("E5_WEB_APP_PORT", 9999))
+# Longest time /status serves the same snapshot while no task changes state
+STATUS_REFRESH_INTERVAL = int(env.get("E5_STATUS_REFRESH_INTERVAL", 5))
 TIME_DELAY = int(env.get("E5_TIME_DELAY", 3))
 
+# Request pacing, "adaptive" gives every tenant a token bucket that speeds up on clean answers and halves on 429/503,
+# "fixed" sleeps TIME_DELAY seconds before every request
+RATE_LIMIT_MODE = env.get("E5_RATE_LIMIT_MODE", "adaptive").lower()
+# Requests per second per tenant
+RATE_LIMIT_INITIAL = float(env.get("E5_RATE_LIMIT_INITIAL", 1))
+RATE_LIMIT_MIN = float(env.get("E5_RATE_LIMIT_MIN", 0.1))
+RATE_LIMIT_MAX = float(env.get("E5_RATE_LIMIT_MAX", 20))
+RATE_LIMIT_BURST = float(env.get("E5_RATE_LIMIT_BURST", 4))
+# Added to the rate after every clean answer, the rate is multiplied by the decrease factor on throttling
+RATE_LIMIT_INCREASE = float(env.get("E5_RATE_LIMIT_INCREASE", 0.1))
+RATE_LIMIT_DECREASE = float(env.get("E5_RATE_LIMIT_DECREASE", 0.5))
+
+# Endpoint sweep configuration ("buffer" downloads whole responses, "stream" discards bodies)
+SWEEP_MODE = env.get("E5_SWEEP_MODE", "buffer").lower()
+STREAM_DRAIN_LIMIT = int(env.get("E5_STREAM_DRAIN_LIMIT", 65536))
+
+# Adaptive endpoint plan, endpoints answering 401/403/404 this many runs in a row are only re-probed occasionally
+ENDPOINT_PLAN_ENABLED = env.get("E5_ENDPOINT_PLAN_ENABLED", "true").lower() == "true"
+ENDPOINT_PLAN_FILE = env.get("E5_ENDPOINT_PLAN_FILE", "endpoint-plan.json")
+# Plan changes within this many seconds are written to the plan file together
+ENDPOINT_PLAN_FLUSH_INTERVAL = float(env.get("E5_ENDPOINT_PLAN_FLUSH_INTERVAL", 5))
+ENDPOINT_DEMOTE_AFTER = int(env.get("E5_ENDPOINT_DEMOTE_AFTER", 3))
+ENDPOINT_REPROBE_INTERVAL = int(env.get("E5_ENDPOINT_REPROBE_INTERVAL", 86400))
+ENDPOINT_PROBE_LIMIT = int(env.get("E5_ENDPOINT_PROBE_LIMIT", 2))
+# Maximum endpoints called per run (0 calls every endpoint not known to fail)
+ENDPOINT_PLAN_BUDGET = int(env.get("E5_ENDPOINT_PLAN_BUDGET", 0))
+
+# Microsoft Graph JSON batching configuration
+GRAPH_BATCH_MODE = env.get("E5_GRAPH_BATCH_MODE", "false").lower() == "true"
+GRAPH_BATCH_SIZE = min(int(env.get("E5_GRAPH_BATCH_SIZE", 20)), 20)
+GRAPH_BATCH_BASE_URL = env.get("E5_GRAPH_BATCH_BASE_URL", "https://graph.microsoft.com")
+
+# HTTP transport configuration
+# Send every Microsoft request to this base URL instead, e.g. http://127.0.0.1:9998 for mock_graph.py (offline testing only)
+UPSTREAM_BASE_URL = env.get("E5_UPSTREAM_BASE_URL")
+HTTP2_ENABLED = env.get("E5_HTTP2_ENABLED", "true").lower() == "true"
+HTTP_MAX_CONNECTIONS = int(env.get("E5_HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(env.get("E5_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_HOST_MAX_CONNECTIONS = int(env.get("E5_HTTP_HOST_MAX_CONNECTIONS", 20))
+HTTP_UPLOAD_MAX_CONNECTIONS = int(env.get("E5_HTTP_UPLOAD_MAX_CONNECTIONS", 2))
+HTTP_KEEPALIVE_EXPIRY = float(env.get("E5_HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_CONNECT_TIMEOUT = float(env.get("E5_HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(env.get("E5_HTTP_READ_TIMEOUT", 30))
+
+# Retry and circuit breaker configuration
+RETRY_MAX_ATTEMPTS = int(env.get("E5_RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(env.get("E5_RETRY_BASE_DELAY", 1))
+RETRY_MAX_DELAY = float(env.get("E5_RETRY_MAX_DELAY", 60))
+BREAKER_FAILURE_THRESHOLD = int(env.get("E5_BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_COOLDOWN = int(env.get("E5_BREAKER_COOLDOWN", 300))
+
+# Built-in scheduler configuration
+SCHEDULE_ENABLED = env.get("E5_SCHEDULE_ENABLED", "false").lower() == "true"
+SCHEDULE_INTERVAL = int(env.get("E5_SCHEDULE_INTERVAL", 4 * 60 * 60))
+SCHEDULE_CATCH_UP_WINDOW = int(env.get("E5_SCHEDULE_CATCH_UP_WINDOW", 600))
+SCHEDULE_STATE_FILE = env.get("E5_SCHEDULE_STATE_FILE", "schedule-state.json")
+
+# Background job queue configuration
+WORKER_COUNT = int(env.get("E5_WORKER_COUNT", 4))
+JOB_QUEUE_SIZE = int(env.get("E5_JOB_QUEUE_SIZE", 1000))
+# Overlapping requests for a profile join its running task; a profile that completed less than
+# PROFILE_MIN_INTERVAL seconds ago is not started again (0 disables the check)
+PROFILE_MIN_INTERVAL = int(env.get("E5_PROFILE_MIN_INTERVAL", 0))
+# How long /call remembers an idempotency key and the answer it gave
+IDEMPOTENCY_TTL = int(env.get("E5_IDEMPOTENCY_TTL", 3600))
+# /call-all-profiles refreshes every account's token before queueing, accounts that fail are reported instead of swept
+PREFLIGHT_ENABLED = env.get("E5_PREFLIGHT_ENABLED", "true").lower() == "true"
+PREFLIGHT_CONCURRENCY = int(env.get("E5_PREFLIGHT_CONCURRENCY", 10))
+# Seconds a task may run before it is cancelled (0 disables the deadline)
+TASK_DEADLINE = int(env.get("E5_TASK_DEADLINE", 900))
+# Seconds the server waits on shutdown for queued and running tasks before cancelling them
+SHUTDOWN_GRACE_PERIOD = int(env.get("E5_SHUTDOWN_GRACE_PERIOD", 30))
+# Profiles are split across this many worker processes by a stable hash of their name, 1 keeps everything in-process
+SHARD_COUNT = max(1, int(env.get("E5_SHARD_COUNT", 1)))
+
 # OneDrive upload configuration
 UPLOAD_LOGS_TO_ONEDRIVE = env.get("E5_UPLOAD_LOGS_TO_ONEDRIVE", "true").lower() == "true"
+# "batch" uploads the new log tail once per batch, "profile" uploads each account's unseen part after every task
+LOG_UPLOAD_MODE = env.get("E5_LOG_UPLOAD_MODE", "batch").lower()
+LOG_UPLOAD_STATE_FILE = env.get("E5_LOG_UPLOAD_STATE_FILE", "log-upload-state.json")
+
+# Task store configuration
+TASK_DB_FILE = env.get("E5_TASK_DB_FILE", "tasks.db")
+TASK_HISTORY_SIZE = int(env.get("E5_TASK_HISTORY_SIZE", 100))
+
+# Access token cache configuration
+TOKEN_CACHE_FILE = env.get("E5_TOKEN_CACHE_FILE", "token-cache.json")
+TOKEN_EXPIRY_MARGIN = int(env.get("E5_TOKEN_EXPIRY_MARGIN", 300))
+# Token refreshes within this many seconds are written to the cache file together
+TOKEN_CACHE_FLUSH_INTERVAL = float(env.get("E5_TOKEN_CACHE_FLUSH_INTERVAL", 1))
 
 # WEB SERVER LOGGING CONFIGURATION
+LOG_FILE = env.get("E5_LOG_FILE", "event-log.txt")
+# "size" rotates at LOG_MAX_BYTES, otherwise a TimedRotatingFileHandler interval such as "midnight" or "h"
+LOG_ROTATE_WHEN = env.get("E5_LOG_ROTATE_WHEN", "size")
+LOG_MAX_BYTES = int(env.get("E5_LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(env.get("E5_LOG_BACKUP_COUNT", 5))
+LOG_COMPRESS = env.get("E5_LOG_COMPRESS", "true").lower() == "true"
+# "text" or "json" (one JSON object per line with task_id/profile fields)
+LOG_FORMAT = env.get("E5_LOG_FORMAT", "text").lower()
+
+# Tracing, timed spans of token exchange, rate limit waits, endpoint calls, connects and uploads as JSON lines
+TRACE_ENABLED = env.get("E5_TRACE_ENABLED", "false").lower() == "true"
+TRACE_FILE = env.get("E5_TRACE_FILE", "trace.jsonl")
+# Share of tasks traced, sampled per task
+TRACE_SAMPLE_RATE = float(env.get("E5_TRACE_SAMPLE_RATE", 1))
+# Directory receiving a cProfile dump of every batch (one batch at a time per process), unset disables profiling
+TRACE_PROFILE_DIR = env.get("E5_TRACE_PROFILE_DIR")
+
 LOGGER_CONFIG_JSON = {
     'version': 1,
     'formatters': {
@@ -58,12 +145,26 @@ LOGGER_CONFIG_JSON = {
             'format': '[%(asctime)s][%(name)s][%(levelname)s] -> %(message)s',
             'datefmt': '%d/%m/%Y %H:%M:%S'
         },
+        'tagged': {
+            'format': '[%(asctime)s][%(name)s][%(levelname)s]%(task_tag)s -> %(message)s',
+            'datefmt': '%d/%m/%Y %H:%M:%S'
+        },
+        'json': {
+            '()': 'logging_pipeline.JsonLinesFormatter'
+        },
+        'message': {
+            'format': '%(message)s'
+        },
     },
     'handlers': {
         'file_handler': {
-            'class': 'logging.FileHandler',
-            'filename': 'event-log.txt',
-            'formatter': 'default'
+            '()': 'logging_pipeline.queue_file_handler',
+            'filename': LOG_FILE,
+            'rotate_when': LOG_ROTATE_WHEN,
+            'max_bytes': LOG_MAX_BYTES,
+            'backup_count': LOG_BACKUP_COUNT,
+            'compress': LOG_COMPRESS,
+            'formatter': 'json' if LOG_FORMAT == 'json' else 'tagged'
         },
         'stream_handler': {
             'class': 'logging.StreamHandler',
@@ -85,3 +186,19 @@ LOGGER_CONFIG_JSON = {
         }
     }
 }
+
+if TRACE_ENABLED:
+    LOGGER_CONFIG_JSON['handlers']['trace_handler'] = {
+        '()': 'logging_pipeline.queue_file_handler',
+        'filename': TRACE_FILE,
+        'rotate_when': LOG_ROTATE_WHEN,
+        'max_bytes': LOG_MAX_BYTES,
+        'backup_count': LOG_BACKUP_COUNT,
+        'compress': LOG_COMPRESS,
+        'formatter': 'message'
+    }
+    LOGGER_CONFIG_JSON['loggers']['e5.trace'] = {
+        'level': 'INFO',
+        'handlers': ['trace_handler'],
+        'propagate': False
+    }
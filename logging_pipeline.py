@@ -0,0 +1,114 @@
+from logging import Filter, Formatter, Handler, LogRecord, getLogger
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from contextvars import ContextVar
+from datetime import datetime
+from queue import SimpleQueue
+import atexit
+import gzip
+import json
+import os
+import shutil
+
+"""
+Queue based logging for the web servers.
+Records are formatted by the caller and written to disk by a background thread, so logging
+from request handlers and background tasks never waits on file I/O.
+"""
+
+# Set by the sweep tasks so every record logged while they run carries their ids
+task_context: ContextVar = ContextVar('task_context', default={})
+
+_listeners = {}
+
+class TaskContextFilter(Filter):
+    def filter(self, record: LogRecord) -> bool:
+        # Records forwarded from shard processes already carry the context of the task that logged them
+        if hasattr(record, 'task_tag'):
+            return True
+        context = task_context.get()
+        record.task_id = context.get('task_id')
+        record.profile = context.get('profile')
+        # Used by the text format, lets /logs index lines by task without parsing messages
+        record.task_tag = f"[{record.task_id}]" if record.task_id else ''
+        return True
+
+class JsonLinesFormatter(Formatter):
+    def format(self, record: LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'task_id': getattr(record, 'task_id', None),
+            'profile': getattr(record, 'profile', None)
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def _compress_rotated(source: str, destination: str):
+    with open(source, 'rb') as source_file, gzip.open(destination, 'wb') as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+def _create_file_handler(filename: str, rotate_when: str, max_bytes: int, backup_count: int, compress: bool):
+    if rotate_when == 'size':
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    else:
+        handler = TimedRotatingFileHandler(filename, when=rotate_when, backupCount=backup_count, encoding='utf-8')
+    if compress:
+        handler.namer = lambda name: f'{name}.gz'
+        handler.rotator = _compress_rotated
+    return handler
+
+def queue_file_handler(
+    filename: str,
+    rotate_when: str = 'size',
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+    compress: bool = True
+):
+    """dictConfig factory returning a QueueHandler whose records are written by a listener thread"""
+    # Configuring logging again (e.g. auth.py after main.py) replaces the previous writer
+    if filename in _listeners:
+        _listeners.pop(filename).stop()
+
+    log_queue = SimpleQueue()
+    listener = QueueListener(
+        log_queue,
+        _create_file_handler(filename, rotate_when, max_bytes, backup_count, compress),
+        respect_handler_level=True
+    )
+    listener.start()
+    _listeners[filename] = listener
+
+    handler = QueueHandler(log_queue)
+    handler.addFilter(TaskContextFilter())
+    return handler
+
+class _ForwardedRecordHandler(Handler):
+    def emit(self, record: LogRecord):
+        # Replays the record through the parent's own logger so it reaches the same handlers
+        getLogger(record.name).handle(record)
+
+def forward_to_queue(log_queue, loggers: dict):
+    """Route the given loggers of a worker process to a queue drained by the parent process"""
+    handler = QueueHandler(log_queue)
+    handler.addFilter(TaskContextFilter())
+    for name, options in loggers.items():
+        logger = getLogger(name)
+        logger.handlers = [handler]
+        logger.setLevel(options.get('level', 'INFO'))
+        logger.propagate = False
+
+def listen_forwarded(log_queue) -> QueueListener:
+    """Start writing the records worker processes put on the queue through the local handlers"""
+    listener = QueueListener(log_queue, _ForwardedRecordHandler())
+    listener.start()
+    return listener
+
+@atexit.register
+def stop_listeners():
+    """Flush the records still queued before the process exits"""
+    while _listeners:
+        _listeners.popitem()[1].stop()
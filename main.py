@@ -1,35 +1,79 @@
-from uvicorn import run
-from quart import Quart, request, Response as quartResponse, send_file
-from httpx import AsyncClient as httpx_client
+from __future__ import annotations
+import time
+
+# Reference point for the time-to-first-request reported by the CLI runner
+PROCESS_STARTED = time.perf_counter()
+
+from httpx import AsyncClient as httpx_client, AsyncBaseTransport, AsyncHTTPTransport, Limits, Timeout, URL
 from asyncio import sleep as async_sleep, gather
-from random import shuffle
+from random import random, shuffle, uniform
+from email.utils import parsedate_to_datetime
 from logging import getLogger
 from config import *
+from logging_pipeline import task_context
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from queue import Queue, Empty
+from datetime import datetime
 import asyncio
+import base64
 import hashlib
+import json
 import os
-from pathlib import Path
+import re
+import sqlite3
+import ssl
+import sys
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from bisect import bisect_left
+
+# Monotonic time by which the running job must finish, retries are not attempted past it
+job_deadline: ContextVar = ContextVar('job_deadline', default=None)
+# Whether the running task was picked by TRACE_SAMPLE_RATE
+trace_sampled: ContextVar = ContextVar('trace_sampled', default=False)
 
 class WebServer:
-    instance = Quart(__name__)
+    # The web stack is only imported when serving, the CLI runner never loads it
+    instance = None
     version = 2.1
     stats = {'version': version, 'totalRequests': 0, 'totalSuccess': 0, 'totalErrors': 0}
 
     def __init__(self):
+        from quart import Quart, Response as quartResponse
+        WebServer.instance = Quart(__name__)
         self.logger = getLogger('uvicorn')
 
         @self.instance.before_serving
         async def before_serve():
             host = f"127.0.0.1:{WEB_APP_PORT}" if WEB_APP_HOST == "0.0.0.0" else f"{WEB_APP_HOST}:{WEB_APP_PORT}"
             self.logger.info(f'Server running on {host}')
+            WorkerPool.start()
+            if SCHEDULE_ENABLED:
+                Scheduler.start()
 
         @self.instance.after_serving
         async def after_serve():
+            await Scheduler.stop()
+            TaskEvents.close()
+            self.logger.info(f'Draining tasks, waiting up to {SHUTDOWN_GRACE_PERIOD} seconds')
+            await WorkerPool.drain(SHUTDOWN_GRACE_PERIOD)
+            await WorkerPool.stop()
+            await ShardRunner.stop(SHUTDOWN_GRACE_PERIOD)
+            await TokenCache.flush()
+            await EndpointPlanner.flush()
+            await HTTPClient.close()
+            TaskStore.close()
+            ProfileStore.close()
             self.logger.info('Server is now stopped!')
 
         @self.instance.before_request
         async def before_request():
-            self.stats['totalRequests'] += 1
+            from quart import request
+            # A poll answered with 304 leaves the counters, and with them the ETag of /, unchanged
+            if request.path != '/' or not ResponseCache.is_fresh('home', tuple(self.stats.values())):
+                self.stats['totalRequests'] += 1
 
         @self.instance.after_request
         async def after_request(response: quartResponse):
@@ -59,7 +103,11 @@ class ErrorHandler:
             403: 'Access denied - invalid password.',
             404: 'Resource not found.',
             405: 'Invalid method',
-            415: 'No json data passed.'
+            415: 'No json data passed.',
+            409: 'Request conflicts with the current state.',
+            429: 'Profile ran too recently - try again later.',
+            500: 'Internal server error.',
+            503: 'Job queue is full - try again later.'
         }
 
         @instance.errorhandler(400)
@@ -76,7 +124,7 @@ class ErrorHandler:
         
         @instance.errorhandler(HTTPError)
         async def http_error(error:HTTPError):
-            error_message = self.error_messages[error.status_code]
+            error_message = self.error_messages.get(error.status_code, f'Error {error.status_code}')
             return error.description or error_message, error.status_code
 
     @classmethod
@@ -85,10 +133,11 @@ class ErrorHandler:
 
 class RouteHandler:
     def __init__(self, instance: Quart):
+        from quart import request, Response as quartResponse, send_file, make_response
     
         @instance.route('/')
         async def home():
-            return WebServer.stats, 200
+            return ResponseCache.respond('home', tuple(WebServer.stats.values()), lambda: WebServer.stats)
 
         @instance.route('/call', methods=['POST'])
         async def create_task():
@@ -97,17 +146,62 @@ class RouteHandler:
 
             if password != WEB_APP_PASSWORD:
                 ErrorHandler.abort(403)
+
+            # A retried request with the same key gets the original answer instead of a second task
+            idempotency_key = request.headers.get('Idempotency-Key') or json_data.get('idempotency_key')
+            if idempotency_key:
+                if SingleFlight.is_pending(idempotency_key):
+                    ErrorHandler.abort(409, 'A request with this idempotency key is still in progress - try again shortly.')
+                previous = SingleFlight.get_response(idempotency_key)
+                if previous:
+                    return {**previous, 'replayed': True}, 200
             
             refresh_token = json_data.get('refresh_token')
             client_id = json_data.get('client_id')
             client_secret = json_data.get('client_secret')
-            access_token = await HTTPClient.acquire_access_token(refresh_token, client_id, client_secret)
+            profile_name = None
+            if json_data.get('profile'):
+                profile = ProfileStore.get(json_data['profile']) or ErrorHandler.abort(404, 'Profile not found.')
+                refresh_token, client_id, client_secret = profile['refresh_token'], profile['client_id'], profile['client_secret']
+                profile_name = profile['name']
+            elif client_id and not client_secret:
+                # Accounts registered under the same app share its secret
+                registered = ProfileStore.get_by_client_id(client_id)
+                client_secret = registered[0]['client_secret'] if registered else None
+
+            flight_key = TokenCache.make_key(refresh_token or REFRESH_TOKEN, client_id or CLIENT_ID, profile_name)
+            running_task_id = SingleFlight.get_task(flight_key)
+            if running_task_id:
+                return {
+                    'message': 'Success - joined the running task.',
+                    'task_id': TaskManager._encrypt_task_id(running_task_id),
+                    'joined': True
+                }, 200
+            wait_time = SingleFlight.get_wait_time(flight_key)
+            if wait_time:
+                ErrorHandler.abort(429, f'Profile ran too recently - try again in {int(wait_time) + 1} seconds.')
 
             import uuid
             task_id = str(uuid.uuid4())[:8]
-            instance.add_background_task(HTTPClient.call_endpoints, access_token, task_id)
+            # Claimed before the token exchange yields, so concurrent requests join this task or wait for its answer
+            SingleFlight.register(flight_key, task_id)
+            if idempotency_key:
+                SingleFlight.reserve(idempotency_key)
+            try:
+                access_token = await HTTPClient.acquire_access_token(refresh_token, client_id, client_secret, profile_name)
+                if not WorkerPool.submit(HTTPClient.call_endpoints, access_token, task_id):
+                    ErrorHandler.abort(503)
+            except BaseException:
+                SingleFlight.release(task_id, False)
+                if idempotency_key:
+                    SingleFlight.discard_response(idempotency_key)
+                raise
+            TaskManager.queue_task(task_id)
 
-            return {'message': 'Success - new task created.', 'task_id': task_id}, 201
+            response = {'message': 'Success - new task created.', 'task_id': task_id}
+            if idempotency_key:
+                SingleFlight.store_response(idempotency_key, response)
+            return response, 201
         
         @instance.route('/call-all-profiles', methods=['POST'])
         async def create_all_profiles_task():
@@ -117,31 +211,102 @@ class RouteHandler:
             if password != WEB_APP_PASSWORD:
                 ErrorHandler.abort(403)
             
-            if not PROFILES:
+            profiles = ProfileStore.get_enabled()
+            if not profiles:
                 ErrorHandler.abort(400, 'No profiles configured. Please add profiles to profiles.json')
+
+            # Reject the whole batch up front rather than queueing only part of it
+            if SHARD_COUNT == 1 and WorkerPool.get_free_slots() < len(profiles):
+                ErrorHandler.abort(503)
             
             import uuid
             batch_id = str(uuid.uuid4())[:8]
             task_ids = []
+            batch_ids = []
+            started_profiles = []
+            skipped_profiles = []
+            candidates = []
             
-            for profile in PROFILES:
+            for profile in profiles:
+                flight_key = TokenCache.make_key(profile['refresh_token'], profile['client_id'], profile['name'])
+                running_task_id = SingleFlight.get_task(flight_key)
+                if running_task_id:
+                    # Already swept by an overlapping batch, report that task instead of starting another
+                    task_ids.append(TaskManager._encrypt_task_id(running_task_id))
+                    running_batch_id = TaskManager._get_batch_id(running_task_id)
+                    if running_batch_id and running_batch_id not in batch_ids:
+                        batch_ids.append(running_batch_id)
+                    continue
+                if SingleFlight.get_wait_time(flight_key):
+                    skipped_profiles.append(TaskManager._encrypt_profile_name(profile['name']))
+                    continue
+
                 task_id = f"{batch_id}-{profile['name']}"
-                # Encrypt task_id for response but keep original for internal use
-                encrypted_profile = TaskManager._encrypt_profile_name(profile['name'])
-                encrypted_task_id = f"{batch_id}-{encrypted_profile}"
-                task_ids.append(encrypted_task_id)
-                instance.add_background_task(
-                    HTTPClient.call_endpoints_for_profile, 
-                    profile, 
-                    task_id
-                )
+                # Registered before the pre-flight so overlapping requests join instead of checking the account again
+                SingleFlight.register(flight_key, task_id)
+                TaskManager.queue_task(task_id)
+                candidates.append((profile, task_id))
+
+            dead_letter = []
+            rejected_profiles = []
+            # Candidates closed or handed to the workers, the rest are cleaned up if the request is aborted
+            handled = set()
+            try:
+                # Accounts whose token cannot be refreshed fail here, only healthy ones are swept
+                reasons = await TokenPreflight.run([profile for profile, _ in candidates]) if PREFLIGHT_ENABLED else []
+                for (profile, task_id), reason in zip(candidates, reasons or [None] * len(candidates)):
+                    # Encrypt task_id for response but keep original for internal use
+                    encrypted_task_id = TaskManager._encrypt_task_id(task_id)
+                    if reason:
+                        TaskManager._close_task(task_id, 'failed', f'Pre-flight: {reason}')
+                        handled.add(task_id)
+                        dead_letter.append({
+                            'task_id': encrypted_task_id,
+                            'profile': TaskManager._encrypt_profile_name(profile['name']),
+                            'reason': reason
+                        })
+                        continue
+                    if SHARD_COUNT == 1:
+                        if not WorkerPool.submit(HTTPClient.call_endpoints_for_profile, profile, task_id):
+                            # Other requests filled the queue while the pre-flight ran
+                            TaskManager._close_task(task_id, 'failed', 'Job queue is full')
+                            handled.add(task_id)
+                            rejected_profiles.append(TaskManager._encrypt_profile_name(profile['name']))
+                            continue
+                        handled.add(task_id)
+                    task_ids.append(encrypted_task_id)
+                    started_profiles.append(profile)
+
+                if started_profiles and SHARD_COUNT > 1:
+                    ShardRunner.submit_batch(batch_id, started_profiles)
+                    handled.update(f"{batch_id}-{profile['name']}" for profile in started_profiles)
+            except BaseException:
+                # A client disconnecting during the pre-flight cancels the handler, its tasks must not stay in flight
+                for _, task_id in candidates:
+                    if task_id not in handled:
+                        TaskManager._close_task(task_id, 'cancelled', 'Request aborted before the task was queued')
+                raise
+
+            closed_count = len(dead_letter) + len(rejected_profiles)
+            if started_profiles or closed_count:
+                batch_ids.insert(0, batch_id)
             
             return {
-                'message': f'Success - {len(PROFILES)} profile tasks created.',
-                'batch_id': batch_id,
+                'message': (
+                    f'Success - {len(started_profiles)} profile tasks created.'
+                    + (f' {len(dead_letter)} profile(s) failed the token pre-flight.' if dead_letter else '')
+                    + (f' {len(rejected_profiles)} profile(s) were rejected by a full job queue.' if rejected_profiles else '')
+                ),
+                'batch_id': batch_id if started_profiles or closed_count else None,
+                'batch_ids': batch_ids,
                 'task_ids': task_ids,
-                'profiles_count': len(PROFILES)
-            }, 201
+                'profiles_count': len(profiles),
+                'healthy_count': len(started_profiles),
+                'joined_count': len(task_ids) - len(started_profiles),
+                'skipped_profiles': skipped_profiles,
+                'dead_letter': dead_letter,
+                'rejected_profiles': rejected_profiles
+            }, 201 if started_profiles else 200
         
         @instance.route('/profiles', methods=['GET'])
         async def get_profiles():
@@ -150,21 +315,50 @@ class RouteHandler:
             if password != WEB_APP_PASSWORD:
                 ErrorHandler.abort(403)
             
-            profiles_info = []
-            for profile in PROFILES:
-                # Encrypt profile name if it contains email
-                display_name = TaskManager._encrypt_profile_name(profile['name']) if '@' in profile['name'] else profile['name']
-                profiles_info.append({
-                    'name': display_name,
-                    'client_id': profile['client_id'][:8] + '...',  # Hide sensitive info
-                    'enabled': profile.get('enabled', True)
-                })
-            
-            return {
-                'profiles': profiles_info,
-                'total_count': len(PROFILES)
-            }, 200
+            snapshot = ProfileStore.get_snapshot()
+            include_disabled = request.args.get('include_disabled', 'False') in {'TRUE', 'True', 'true'}
+
+            def build():
+                profiles_info = snapshot.summaries
+                if not include_disabled:
+                    profiles_info = [profile for profile in profiles_info if profile['enabled']]
+                return {
+                    'profiles': profiles_info,
+                    'total_count': len(profiles_info)
+                }
+
+            # Snapshots are replaced on every reload, so the snapshot itself tells whether profiles changed
+            return ResponseCache.respond(f'profiles:{include_disabled}', snapshot, build)
+
+        @instance.route('/profiles/<name>', methods=['PATCH'])
+        async def update_profile(name: str):
+            json_data = await request.json or ErrorHandler.abort(415)
+            password = json_data.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            if not isinstance(json_data.get('enabled'), bool):
+                ErrorHandler.abort(400, 'The enabled field must be true or false.')
+            try:
+                updated = await asyncio.to_thread(ProfileStore.set_enabled, name, json_data['enabled'])
+            except (OSError, json.JSONDecodeError, sqlite3.Error) as e:
+                ErrorHandler.abort(500, f'Error updating profile: {e}')
+            if not updated:
+                ErrorHandler.abort(404, 'Profile not found.')
+
+            return {'message': 'Success - profile updated.', 'name': name, 'enabled': json_data['enabled']}, 200
         
+        @instance.route('/profiles/<name>/plan')
+        async def get_endpoint_plan(name: str):
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            profile = ProfileStore.get(name) or ErrorHandler.abort(404, 'Profile not found.')
+            return EndpointPlanner.get_plan(profile['name'], HTTPClient.graph_endpoints), 200
+
         @instance.route('/logs')
         async def send_logs():
             password = request.args.get('password') or ErrorHandler.abort(401)
@@ -173,25 +367,229 @@ class RouteHandler:
             if password != WEB_APP_PASSWORD:
                 ErrorHandler.abort(403)
 
-            return await send_file('event-log.txt', as_attachment=as_file)
+            task_id = request.args.get('task_id')
+            since = request.args.get('since')
+            try:
+                tail = int(request.args['tail']) if 'tail' in request.args else None
+                since = datetime.fromisoformat(since).timestamp() if since else None
+            except ValueError:
+                ErrorHandler.abort(400)
+
+            if not os.path.exists(LOG_FILE):
+                ErrorHandler.abort(404)
+
+            if task_id or since is not None:
+                content = await LogIndex.query(task_id, since, tail)
+            elif tail is not None:
+                content = await asyncio.to_thread(LogIndex.read_tail, LOG_FILE, tail)
+            else:
+                # Byte ranges (Range header) are answered by send_file itself
+                return await send_file(LOG_FILE, as_attachment=as_file, conditional=True)
+
+            return quartResponse(content, mimetype='text/plain')
         
+        @instance.route('/metrics')
+        async def get_metrics():
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            return quartResponse(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+        @instance.route('/tasks/<task_id>')
+        async def get_task(task_id: str):
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            page, per_page, limit, offset = Pagination.from_request()
+            task = await asyncio.to_thread(TaskStore.get_task, task_id, limit, offset) or ErrorHandler.abort(404)
+            return {**task, 'page': page, 'per_page': per_page}, 200
+
+        @instance.route('/tasks/<task_id>', methods=['DELETE'])
+        async def cancel_task(task_id: str):
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            state = WorkerPool.cancel(task_id, 'Cancelled by request')
+            if state is None:
+                task = await asyncio.to_thread(TaskStore.get_task, task_id, 0, 0) or ErrorHandler.abort(404)
+                ErrorHandler.abort(409, f"Task is {task['status']} and cannot be cancelled.")
+            # A running sweep stops at its next await, its final state shows up in /tasks/<task_id>
+            return {'task_id': task_id, 'status': state}, 202 if state == 'cancelling' else 200
+
+        @instance.route('/batches/<batch_id>')
+        async def get_batch(batch_id: str):
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            page, per_page, limit, offset = Pagination.from_request()
+            batch = await asyncio.to_thread(TaskStore.get_batch, batch_id, limit, offset) or ErrorHandler.abort(404)
+            return {**batch, 'page': page, 'per_page': per_page}, 200
+
+        @instance.route('/batches/<batch_id>/wait')
+        async def wait_for_batch(batch_id: str):
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            try:
+                timeout = min(300.0, max(0.0, float(request.args.get('timeout', 30))))
+            except ValueError:
+                ErrorHandler.abort(400)
+
+            deadline = time.monotonic() + timeout
+            sequence = TaskEvents.get_sequence()
+            while TaskManager.get_batch_pending_count(batch_id) and not TaskEvents.is_closed():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                events = await TaskEvents.wait(sequence, remaining)
+                if events:
+                    sequence = events[-1][0]
+
+            batch = (
+                await asyncio.to_thread(TaskStore.get_batch, batch_id, Pagination.default_per_page, 0)
+                or ErrorHandler.abort(404)
+            )
+            pending = TaskManager.get_batch_pending_count(batch_id)
+            return {**batch, 'pending': pending, 'done': pending == 0}, 200
+
+        @instance.route('/status/stream')
+        async def stream_task_status():
+            password = request.args.get('password') or ErrorHandler.abort(401)
+
+            if password != WEB_APP_PASSWORD:
+                ErrorHandler.abort(403)
+
+            try:
+                last_event_id = int(request.headers.get('Last-Event-ID', TaskEvents.get_sequence()))
+            except ValueError:
+                last_event_id = TaskEvents.get_sequence()
+
+            async def event_stream():
+                sequence = last_event_id
+                snapshot = json.dumps({
+                    'status': 'snapshot',
+                    'sequence': TaskEvents.get_sequence(),
+                    'running_tasks': TaskManager.get_running_tasks_count(),
+                    'is_busy': TaskManager.is_busy()
+                })
+                yield f'data: {snapshot}\n\n'
+                while not TaskEvents.is_closed():
+                    events = await TaskEvents.wait(sequence, 15)
+                    if not events:
+                        yield ': keep-alive\n\n'
+                        continue
+                    for sequence, frame in events:
+                        yield frame
+
+            response = await make_response(
+                event_stream(),
+                {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'}
+            )
+            response.timeout = None
+            return response
+
         @instance.route('/status')
         async def get_task_status():
             password = request.args.get('password') or ErrorHandler.abort(401)
             
             if password != WEB_APP_PASSWORD:
                 ErrorHandler.abort(403)
-            
-            return {
+
+            # Counters such as retries or the scheduler countdown move without a task event, so the
+            # snapshot is also rebuilt every STATUS_REFRESH_INTERVAL seconds
+            version = (
+                TaskManager.get_version(),
+                ProfileStore.get_snapshot(),
+                int(time.monotonic() // max(1, STATUS_REFRESH_INTERVAL))
+            )
+            return ResponseCache.respond('status', version, lambda: {
                 'running_tasks': TaskManager.get_running_tasks_count(),
                 'task_history': TaskManager.get_task_history(),
-                'is_busy': TaskManager.is_busy()
-            }, 200
+                'is_busy': TaskManager.is_busy(),
+                'queue': WorkerPool.get_stats(),
+                'scheduler': Scheduler.get_stats(),
+                'retries': RetryPolicy.get_stats(),
+                'circuit_breakers': CircuitBreaker.get_stats(),
+                'token_cache': TokenCache.get_stats(),
+                'endpoint_plan': EndpointPlanner.get_stats(),
+                'single_flight': SingleFlight.get_stats(),
+                'rate_limiter': TenantRateLimiter.get_stats(),
+                'preflight': TokenPreflight.get_stats(),
+                'shards': ShardRunner.get_stats()
+            })
+
+class Pagination:
+    default_per_page = 50
+    max_per_page = 200
+
+    @classmethod
+    def from_request(cls):
+        """Read page/per_page from the query string and return (page, per_page, limit, offset)"""
+        from quart import request
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+            per_page = min(cls.max_per_page, max(1, int(request.args.get('per_page', cls.default_per_page))))
+        except ValueError:
+            ErrorHandler.abort(400)
+        return page, per_page, per_page, (page - 1) * per_page
+
+class ResponseCache:
+    """Serialized bodies of polled read endpoints with strong ETags, rebuilt only when their version changes"""
+    _entries = {}
+
+    @classmethod
+    def get(cls, key: str, version, build) -> tuple:
+        entry = cls._entries.get(key)
+        if entry is None or entry[0] != version:
+            body = json.dumps(build()).encode()
+            entry = cls._entries[key] = (version, body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+        return entry
+
+    @classmethod
+    def _matches(cls, etag: str) -> bool:
+        from quart import request
+        header = request.headers.get('If-None-Match')
+        if not header:
+            return False
+        # If-None-Match compares weakly, a W/ prefix added by a proxy still matches
+        candidates = {candidate.strip().removeprefix('W/') for candidate in header.split(',')}
+        return '*' in candidates or etag in candidates
+
+    @classmethod
+    def is_fresh(cls, key: str, version) -> bool:
+        """Whether the request will be answered with 304, without building anything"""
+        entry = cls._entries.get(key)
+        return entry is not None and entry[0] == version and cls._matches(entry[2])
+
+    @classmethod
+    def respond(cls, key: str, version, build):
+        from quart import Response as quartResponse
+        _, body, etag = cls.get(key, version, build)
+        # no-cache lets clients keep the body but makes them revalidate every time
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if cls._matches(etag):
+            return quartResponse(status=304, headers=headers)
+        return quartResponse(body, 200, headers=headers, content_type='application/json')
 
 class TaskManager:
     _running_tasks = 0
-    _task_history = []
-    _max_history = 10
+    _task_history = deque(maxlen=TASK_HISTORY_SIZE)
+    _batch_pending = {}
+    _batch_started = {}
+    _task_started = {}
+    _cancel_reasons = {}
+    # Bumped on every task state change, tells cached /status snapshots they are stale
+    _version = 0
     
     @classmethod
     def _encrypt_profile_name(cls, profile_name: str) -> str:
@@ -202,16 +600,80 @@ class TaskManager:
             return hash_obj.hexdigest()[:8]
         return profile_name
     
+    @classmethod
+    def queue_task(cls, task_id: str):
+        cls._version += 1
+        batch_id = cls._get_batch_id(task_id)
+        if batch_id:
+            if batch_id not in cls._batch_pending:
+                Tracer.start_profile(batch_id)
+            cls._batch_pending[batch_id] = cls._batch_pending.get(batch_id, 0) + 1
+            cls._batch_started.setdefault(batch_id, time.monotonic())
+        TaskStore.record_start(cls._encrypt_task_id(task_id), batch_id, None, 'queued')
+
     @classmethod
     def start_task(cls, task_id: str):
         cls._running_tasks += 1
-        cls._add_to_history(task_id, 'started')
+        cls._task_started[task_id] = time.monotonic()
+        entry = cls._add_to_history(task_id, 'started')
+        TaskStore.record_start(entry['task_id'], cls._get_batch_id(task_id), entry['timestamp'])
         
     @classmethod
-    def finish_task(cls, task_id: str, success: bool = True):
+    def finish_task(cls, task_id: str, success: bool = True, error: str = None):
+        cls._running_tasks = max(0, cls._running_tasks - 1)
+        if task_id in cls._task_started:
+            # Only "<batch_id>-<profile>" tasks name a profile, single /call tasks must not add a series each
+            profile_name = task_id.split('-', 1)[1] if cls._get_batch_id(task_id) else None
+            Metrics.observe_task(time.monotonic() - cls._task_started.pop(task_id), profile_name)
+        cls._close_task(task_id, 'completed' if success else 'failed', error)
+
+    @classmethod
+    def set_cancel_reason(cls, task_id: str, reason: str):
+        cls._cancel_reasons[cls._encrypt_task_id(task_id)] = reason
+
+    @classmethod
+    def cancel_task(cls, task_id: str):
+        """Record a running task as cancelled, tasks that already finished are left as they are"""
+        if task_id not in cls._task_started:
+            return
         cls._running_tasks = max(0, cls._running_tasks - 1)
-        status = 'completed' if success else 'failed'
+        del cls._task_started[task_id]
+        reason = cls._cancel_reasons.pop(cls._encrypt_task_id(task_id), 'Cancelled')
+        cls._close_task(task_id, 'cancelled', reason)
+
+    @classmethod
+    def cancel_queued_task(cls, task_id: str, reason: str):
+        """Record a task that was cancelled before a worker picked it up"""
+        cls._close_task(task_id, 'cancelled', reason)
+
+    @classmethod
+    def _close_task(cls, task_id: str, status: str, error: str = None):
+        SingleFlight.release(task_id, status == 'completed')
+        cls._release_batch_slot(task_id)
+        entry = cls._add_to_history(task_id, status)
+        TaskStore.record_finish(entry['task_id'], status, entry['timestamp'], error)
+
+    @classmethod
+    def resolve_shard_task(cls, task_id: str, status: str):
+        """Account for a task a shard process ran, the shard already persisted its outcome"""
+        SingleFlight.release(task_id, status == 'completed')
+        cls._release_batch_slot(task_id)
         cls._add_to_history(task_id, status)
+
+    @classmethod
+    def _release_batch_slot(cls, task_id: str):
+        batch_id = cls._get_batch_id(task_id)
+        if batch_id in cls._batch_pending:
+            cls._batch_pending[batch_id] -= 1
+            if cls._batch_pending[batch_id] <= 0:
+                del cls._batch_pending[batch_id]
+                Metrics.observe_batch(time.monotonic() - cls._batch_started.pop(batch_id, time.monotonic()))
+                Tracer.stop_profile(batch_id)
+
+    @classmethod
+    def record_results(cls, task_id: str, results: dict):
+        """Persist the per-endpoint outcome of a sweep"""
+        TaskStore.record_endpoint_calls(cls._encrypt_task_id(task_id), results)
         
     @classmethod
     def get_running_tasks_count(cls):
@@ -219,193 +681,2548 @@ class TaskManager:
         
     @classmethod
     def is_busy(cls):
-        return cls._running_tasks > 0
+        return cls._running_tasks > 0 or WorkerPool.get_pending_count() > 0 or ShardRunner.get_running_count() > 0
         
     @classmethod
     def get_task_history(cls):
-        return cls._task_history.copy()
+        return list(cls._task_history)
+
+    @classmethod
+    def get_version(cls) -> int:
+        return cls._version
+
+    @classmethod
+    def get_batch_pending_count(cls, batch_id: str) -> int:
+        return cls._batch_pending.get(batch_id, 0)
+
+    @classmethod
+    def _get_batch_id(cls, task_id: str):
+        # Profile tasks are named "<batch_id>-<profile>", single /call tasks have no batch
+        return task_id.split('-', 1)[0] if '-' in task_id else None
         
     @classmethod
-    def _add_to_history(cls, task_id: str, status: str):
-        from datetime import datetime
-        # Encrypt task_id if it contains profile name with @
-        encrypted_task_id = task_id
+    def _encrypt_task_id(cls, task_id: str) -> str:
+        """Encrypt task_id if it contains profile name with @"""
         if '-' in task_id:
             parts = task_id.split('-', 1)
             if len(parts) == 2:
                 batch_id, profile_name = parts
                 encrypted_profile = cls._encrypt_profile_name(profile_name)
-                encrypted_task_id = f"{batch_id}-{encrypted_profile}"
-        
+                return f"{batch_id}-{encrypted_profile}"
+        return task_id
+
+    @classmethod
+    def _add_to_history(cls, task_id: str, status: str):
+        from datetime import datetime
         entry = {
-            'task_id': encrypted_task_id,
+            'task_id': cls._encrypt_task_id(task_id),
             'status': status,
             'timestamp': datetime.now().isoformat()
         }
+        cls._version += 1
         cls._task_history.append(entry)
-        if len(cls._task_history) > cls._max_history:
-            cls._task_history.pop(0)
+        TaskEvents.publish({**entry, 'batch_id': cls._get_batch_id(task_id)})
+        return entry
 
-class HTTPClient:
-    instance = httpx_client()
-    token_endpoint = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
-    graph_endpoints = [
-            'https://graph.microsoft.com/v1.0/me/drive/root',
-            'https://graph.microsoft.com/v1.0/me/drive',
-            'https://graph.microsoft.com/v1.0/drive/root',
-            'https://graph.microsoft.com/v1.0/users',
-            'https://graph.microsoft.com/v1.0/me/messages',
-            'https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messageRules',
-            'https://graph.microsoft.com/v1.0/me/drive/root/children',
-            'https://api.powerbi.com/v1.0/myorg/apps',
-            'https://graph.microsoft.com/v1.0/me/mailFolders',
-            'https://graph.microsoft.com/v1.0/me/outlook/masterCategories',
-            'https://graph.microsoft.com/v1.0/applications?$count=true',
-            'https://graph.microsoft.com/v1.0/me/?$select=displayName,skills',
-            'https://graph.microsoft.com/v1.0/me/mailFolders/Inbox/messages/delta',
-            'https://graph.microsoft.com/beta/me/outlook/masterCategories',
-            'https://graph.microsoft.com/beta/me/messages?$select=internetMessageHeaders&$top=1',
-            'https://graph.microsoft.com/v1.0/sites/root/lists',
-            'https://graph.microsoft.com/v1.0/sites/root',
-            'https://graph.microsoft.com/v1.0/sites/root/drives'
-        ]
+class SingleFlight:
+    """Keeps at most one task in flight per account, later requests join it instead of sweeping again"""
+    _in_flight = {}
+    _task_keys = {}
+    _last_completed = {}
+    _idempotency_keys = OrderedDict()
+    _stats = {'started': 0, 'joined': 0, 'throttled': 0, 'replayed': 0}
 
     @classmethod
-    async def acquire_access_token(
-        cls,
-        refresh_token:str = None,
-        client_id:str = None,
-        client_secret:str = None
-    ):
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': refresh_token or REFRESH_TOKEN,
-            'client_id': client_id or CLIENT_ID,
-            'client_secret': client_secret or CLIENT_SECRET,
-            'redirect_uri': 'http://localhost:53682/'
-        }
+    def get_task(cls, key: str):
+        """Task id already running for this account, or None"""
+        task_id = cls._in_flight.get(key)
+        if task_id:
+            cls._stats['joined'] += 1
+        return task_id
 
-        response = await cls.instance.post(cls.token_endpoint, headers=headers, data=data)
-        return response.json().get('access_token') or ErrorHandler.abort(
-            401,
-            'Failed to acquire the access token. Please verify your refresh token and try again.'
-        )
-    
     @classmethod
-    async def call_endpoints(cls, access_token:str, task_id: str = None):
-        import uuid
-        if not task_id:
-            task_id = str(uuid.uuid4())[:8]
-            
-        TaskManager.start_task(task_id)
-        
-        try:
-            shuffle(cls.graph_endpoints)
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
+    def get_wait_time(cls, key: str) -> float:
+        """Seconds until PROFILE_MIN_INTERVAL has passed since the account's last completed run"""
+        if not PROFILE_MIN_INTERVAL or key not in cls._last_completed:
+            return 0
+        remaining = cls._last_completed[key] + PROFILE_MIN_INTERVAL - time.time()
+        if remaining > 0:
+            cls._stats['throttled'] += 1
+        return max(0, remaining)
 
-            for endpoint in cls.graph_endpoints:
-                await async_sleep(TIME_DELAY)
-                try:
-                    response = await cls.instance.get(endpoint, headers=headers)
-                    # Log successful calls if needed
-                except Exception as e:
-                    # Log errors if needed
-                    pass
-            
-            TaskManager.finish_task(task_id, True)
-            # Upload log file to OneDrive after successful completion
-            if UPLOAD_LOGS_TO_ONEDRIVE:
-                await cls.upload_log_to_onedrive(access_token)
-        except Exception as e:
-            TaskManager.finish_task(task_id, False)
-            raise
-    
     @classmethod
-    async def call_endpoints_for_profile(cls, profile: dict, task_id: str = None):
-        """Call endpoints for a specific profile"""
-        import uuid
-        if not task_id:
-            task_id = str(uuid.uuid4())[:8]
-            
-        TaskManager.start_task(task_id)
-        
-        try:
-            # Get access token for this profile
-            access_token = await cls.acquire_access_token(
-                profile['refresh_token'],
-                profile['client_id'],
-                profile['client_secret']
-            )
-            
-            shuffle(cls.graph_endpoints)
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
+    def register(cls, key: str, task_id: str):
+        cls._in_flight[key] = task_id
+        cls._task_keys[task_id] = key
+        cls._stats['started'] += 1
 
-            for endpoint in cls.graph_endpoints:
-                await async_sleep(TIME_DELAY)
-                try:
-                    response = await cls.instance.get(endpoint, headers=headers)
-                    # Log successful calls if needed
-                except Exception as e:
-                    # Log errors if needed
-                    pass
-            
-            TaskManager.finish_task(task_id, True)
-            # Upload log file to OneDrive after successful completion for this profile
-            if UPLOAD_LOGS_TO_ONEDRIVE:
-                await cls.upload_log_to_onedrive(access_token, profile['name'])
-        except Exception as e:
-            TaskManager.finish_task(task_id, False)
-            raise
-    
     @classmethod
-    async def upload_log_to_onedrive(cls, access_token: str, profile_name: str = None):
-        """Upload log file to OneDrive after task completion"""
-        try:
-            log_file_path = "event-log.txt"
-            
-            # Check if log file exists
-            if not os.path.exists(log_file_path):
+    def release(cls, task_id: str, success: bool):
+        key = cls._task_keys.pop(task_id, None)
+        if key is None:
+            return
+        if cls._in_flight.get(key) == task_id:
+            del cls._in_flight[key]
+        if success:
+            cls._last_completed[key] = time.time()
+
+    @classmethod
+    def get_response(cls, idempotency_key: str):
+        """Response already sent for this idempotency key, while it has not expired"""
+        now = time.time()
+        while cls._idempotency_keys and next(iter(cls._idempotency_keys.values()))[0] <= now:
+            cls._idempotency_keys.popitem(last=False)
+        entry = cls._idempotency_keys.get(idempotency_key)
+        if entry and entry[1] is not None:
+            cls._stats['replayed'] += 1
+            return entry[1]
+        return None
+
+    @classmethod
+    def reserve(cls, idempotency_key: str):
+        """Hold the key while its request is still acquiring a token, its response is stored once known"""
+        cls._idempotency_keys[idempotency_key] = (time.time() + IDEMPOTENCY_TTL, None)
+
+    @classmethod
+    def is_pending(cls, idempotency_key: str) -> bool:
+        entry = cls._idempotency_keys.get(idempotency_key)
+        return entry is not None and entry[1] is None
+
+    @classmethod
+    def store_response(cls, idempotency_key: str, response: dict):
+        cls._idempotency_keys[idempotency_key] = (time.time() + IDEMPOTENCY_TTL, response)
+
+    @classmethod
+    def discard_response(cls, idempotency_key: str):
+        cls._idempotency_keys.pop(idempotency_key, None)
+
+    @classmethod
+    def get_stats(cls):
+        return {**cls._stats, 'in_flight': len(cls._in_flight)}
+
+class TokenPreflight:
+    """Refreshes the access tokens of a batch up front, so dead accounts fail fast instead of inside their task"""
+    _stats = {'checked': 0, 'healthy': 0, 'dead': 0}
+    _dead_letter = deque(maxlen=TASK_HISTORY_SIZE)
+
+    @classmethod
+    async def _check(cls, semaphore: asyncio.Semaphore, profile: dict):
+        async with semaphore:
+            try:
+                # A valid token lands in the cache, so the task itself does not refresh again
+                await HTTPClient.acquire_access_token(
+                    profile['refresh_token'],
+                    profile['client_id'],
+                    profile['client_secret'],
+                    profile['name']
+                )
+                return None
+            except HTTPError as e:
+                return e.description or f'Error {e.status_code}'
+            except Exception as e:
+                return f'{type(e).__name__}: {e}'
+
+    @classmethod
+    async def run(cls, profiles: list) -> list:
+        """Failure reason of every profile in the given order, None for healthy ones"""
+        semaphore = asyncio.Semaphore(max(1, PREFLIGHT_CONCURRENCY))
+        reasons = await gather(*(cls._check(semaphore, profile) for profile in profiles))
+        timestamp = datetime.now().isoformat()
+        for profile, reason in zip(profiles, reasons):
+            cls._stats['checked'] += 1
+            if reason is None:
+                cls._stats['healthy'] += 1
+                continue
+            cls._stats['dead'] += 1
+            cls._dead_letter.append({
+                'profile': TaskManager._encrypt_profile_name(profile['name']),
+                'reason': reason,
+                'timestamp': timestamp
+            })
+        return reasons
+
+    @classmethod
+    def get_stats(cls):
+        return {**cls._stats, 'dead_letter': list(cls._dead_letter)}
+
+class TaskEvents:
+    _events = deque(maxlen=TASK_HISTORY_SIZE)
+    _sequence = 0
+    _changed = None
+    _closed = False
+
+    @classmethod
+    def publish(cls, event: dict):
+        """Record an event and wake every waiter, the SSE frame is built once for all subscribers"""
+        cls._sequence += 1
+        payload = json.dumps({
+            **event,
+            'sequence': cls._sequence,
+            'running_tasks': TaskManager.get_running_tasks_count(),
+            'is_busy': TaskManager.is_busy()
+        })
+        cls._events.append((cls._sequence, f'id: {cls._sequence}\ndata: {payload}\n\n'))
+        if cls._changed is not None:
+            cls._changed.set()
+            cls._changed = None
+
+    @classmethod
+    def get_sequence(cls) -> int:
+        return cls._sequence
+
+    @classmethod
+    async def wait(cls, after_sequence: int, timeout: float):
+        """Return the SSE frames newer than after_sequence, waiting up to timeout seconds for one"""
+        if cls._sequence <= after_sequence and not cls._closed:
+            if cls._changed is None:
+                cls._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(cls._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [(sequence, frame) for sequence, frame in cls._events if sequence > after_sequence]
+
+    @classmethod
+    def is_closed(cls) -> bool:
+        return cls._closed
+
+    @classmethod
+    def close(cls):
+        cls._closed = True
+        if cls._changed is not None:
+            cls._changed.set()
+            cls._changed = None
+
+class TaskStore:
+    _connection = None
+    _lock = threading.Lock()
+    # State changes are committed by a writer thread, a busy shard lock never blocks the event loop
+    _writes = Queue()
+    _writer = None
+    # Statements committed together in one transaction
+    write_batch_size = 500
+    schema = [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            batch_id TEXT,
+            status TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS endpoint_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            status_code INTEGER,
+            latency_ms REAL,
+            bytes INTEGER
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_tasks_batch_id ON tasks (batch_id, started_at)',
+        'CREATE INDEX IF NOT EXISTS idx_endpoint_calls_task_id ON endpoint_calls (task_id)'
+    ]
+
+    @classmethod
+    def _get_connection(cls):
+        if cls._connection is None:
+            # Shard processes write to the same database, so wait for their locks instead of failing
+            cls._connection = sqlite3.connect(TASK_DB_FILE, timeout=30, check_same_thread=False)
+            cls._connection.row_factory = sqlite3.Row
+            cls._connection.execute('PRAGMA journal_mode=WAL')
+            cls._connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in cls.schema:
+                cls._connection.execute(statement)
+            cls._connection.commit()
+        return cls._connection
+
+    @classmethod
+    def _write(cls, statement: str, parameters=()):
+        if cls._writer is None or not cls._writer.is_alive():
+            cls._writer = threading.Thread(target=cls._write_loop, name='task-store-writer', daemon=True)
+            cls._writer.start()
+        cls._writes.put((statement, parameters))
+
+    @classmethod
+    def _write_loop(cls):
+        while True:
+            batch = [cls._writes.get()]
+            while batch[-1] is not None and len(batch) < cls.write_batch_size:
+                try:
+                    batch.append(cls._writes.get_nowait())
+                except Empty:
+                    break
+            statements = [item for item in batch if item is not None]
+            try:
+                with cls._lock:
+                    connection = cls._get_connection()
+                    for statement, parameters in statements:
+                        if isinstance(parameters, list):
+                            connection.executemany(statement, parameters)
+                        else:
+                            connection.execute(statement, parameters)
+                    connection.commit()
+            except sqlite3.Error as e:
+                # The store is bookkeeping only, never fail a task because of it
+                print(f"Error writing task store: {e}")
+            finally:
+                for _ in batch:
+                    cls._writes.task_done()
+            if batch[-1] is None:
                 return
-            
-            # Generate unique filename with timestamp
-            from datetime import datetime
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            profile_suffix = f"_{TaskManager._encrypt_profile_name(profile_name)}" if profile_name else ""
-            remote_filename = f"e5-renewal-log_{timestamp}{profile_suffix}.txt"
-            
-            # Read log file content
-            with open(log_file_path, 'rb') as file:
-                file_content = file.read()
-            
-            # Upload to OneDrive using Microsoft Graph API
-            upload_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/logs/{remote_filename}:/content"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'text/plain'
-            }
-            
-            response = await cls.instance.put(upload_url, headers=headers, content=file_content)
-            
-            if response.status_code == 201:
-                # Successfully uploaded
-                print(f"Log file uploaded to OneDrive: {remote_filename}")
-            else:
-                print(f"Failed to upload log file: {response.status_code}")
-                
-        except Exception as e:
-            # Don't let upload errors affect main task
-            print(f"Error uploading log to OneDrive: {str(e)}")
 
-web_server = WebServer().instance
+    @classmethod
+    def flush(cls):
+        """Wait until every queued write is committed"""
+        cls._writes.join()
 
-if __name__ == '__main__':
+    @classmethod
+    def _read(cls, statement: str, parameters=()):
+        # Reads see the task's latest state, not the one before its queued writes
+        cls.flush()
+        with cls._lock:
+            return [dict(row) for row in cls._get_connection().execute(statement, parameters).fetchall()]
+
+    @classmethod
+    def record_start(cls, task_id: str, batch_id: str, timestamp: str, status: str = 'started'):
+        cls._write(
+            'INSERT OR REPLACE INTO tasks (task_id, batch_id, status, started_at) VALUES (?, ?, ?, ?)',
+            (task_id, batch_id, status, timestamp)
+        )
+
+    @classmethod
+    def record_finish(cls, task_id: str, status: str, timestamp: str, error: str = None):
+        cls._write(
+            'UPDATE tasks SET status = ?, finished_at = ?, error = ? WHERE task_id = ?',
+            (status, timestamp, error, task_id)
+        )
+
+    @classmethod
+    def record_endpoint_calls(cls, task_id: str, results: dict):
+        cls._write(
+            'INSERT INTO endpoint_calls (task_id, endpoint, status_code, latency_ms, bytes) VALUES (?, ?, ?, ?, ?)',
+            [
+                (task_id, endpoint, result['status_code'], result['latency_ms'], result['bytes'])
+                for endpoint, result in results.items()
+            ]
+        )
+
+    @classmethod
+    def get_task(cls, task_id: str, limit: int, offset: int):
+        tasks = cls._read('SELECT * FROM tasks WHERE task_id = ?', (task_id,))
+        if not tasks:
+            return None
+        task = tasks[0]
+        task['endpoint_calls'] = cls._read(
+            'SELECT endpoint, status_code, latency_ms, bytes FROM endpoint_calls WHERE task_id = ? ORDER BY id LIMIT ? OFFSET ?',
+            (task_id, limit, offset)
+        )
+        task['endpoint_calls_count'] = cls._read(
+            'SELECT COUNT(*) AS count FROM endpoint_calls WHERE task_id = ?', (task_id,)
+        )[0]['count']
+        return task
+
+    @classmethod
+    def get_batch(cls, batch_id: str, limit: int, offset: int):
+        summary = cls._read(
+            'SELECT status, COUNT(*) AS count FROM tasks WHERE batch_id = ? GROUP BY status', (batch_id,)
+        )
+        if not summary:
+            return None
+        return {
+            'batch_id': batch_id,
+            'summary': {row['status']: row['count'] for row in summary},
+            'tasks_count': sum(row['count'] for row in summary),
+            'tasks': cls._read(
+                'SELECT task_id, status, started_at, finished_at, error FROM tasks '
+                'WHERE batch_id = ? ORDER BY started_at LIMIT ? OFFSET ?',
+                (batch_id, limit, offset)
+            )
+        }
+
+    @classmethod
+    def close(cls):
+        if cls._writer is not None and cls._writer.is_alive():
+            cls._writes.put(None)
+            cls._writer.join()
+        cls._writer = None
+        with cls._lock:
+            if cls._connection is not None:
+                cls._connection.close()
+                cls._connection = None
+
+class ProfileSnapshot:
+    """Immutable view of the profiles, swapped in whole so readers never see a half reload"""
+
+    def __init__(self, profiles: list, version):
+        self.version = version
+        self.by_name = {profile['name']: profile for profile in profiles}
+        # Responses show hashed names for e-mail profiles, so lookups accept those as well
+        self.by_display_name = {TaskManager._encrypt_profile_name(name): profile for name, profile in self.by_name.items()}
+        self.by_client_id = {}
+        for profile in profiles:
+            self.by_client_id.setdefault(profile['client_id'], []).append(profile)
+        self.enabled = [profile for profile in profiles if profile.get('enabled', True)]
+        self.summaries = [
+            {
+                'name': TaskManager._encrypt_profile_name(profile['name']),
+                'client_id': profile['client_id'][:8] + '...',  # Hide sensitive info
+                'enabled': profile.get('enabled', True)
+            }
+            for profile in profiles
+        ]
+
+class ProfileStore:
+    _snapshot = None
+    _checked_at = 0
+    _connection = None
+    _lock = threading.Lock()
+    fields = ['name', 'client_id', 'client_secret', 'refresh_token', 'enabled']
+    schema = """CREATE TABLE IF NOT EXISTS profiles (
+        name TEXT PRIMARY KEY,
+        client_id TEXT NOT NULL,
+        client_secret TEXT NOT NULL,
+        refresh_token TEXT NOT NULL,
+        enabled INTEGER NOT NULL DEFAULT 1
+    )"""
+
+    @classmethod
+    def _get_connection(cls):
+        if cls._connection is None:
+            cls._connection = sqlite3.connect(PROFILE_DB_FILE, timeout=30, check_same_thread=False)
+            cls._connection.row_factory = sqlite3.Row
+            cls._connection.execute('PRAGMA journal_mode=WAL')
+            cls._connection.execute(cls.schema)
+            cls._connection.commit()
+            # The database holds client secrets and refresh tokens, SQLite gives its -wal and -shm files the same mode
+            for path in (PROFILE_DB_FILE, f'{PROFILE_DB_FILE}-wal', f'{PROFILE_DB_FILE}-shm'):
+                if os.path.exists(path):
+                    os.chmod(path, 0o600)
+            # The first start on SQLite imports the existing profiles.json
+            if not cls._connection.execute('SELECT COUNT(*) FROM profiles').fetchone()[0]:
+                profiles = cls._read_file() or []
+                cls._connection.executemany(
+                    'INSERT OR IGNORE INTO profiles (name, client_id, client_secret, refresh_token, enabled) VALUES (?, ?, ?, ?, ?)',
+                    [
+                        (profile['name'], profile['client_id'], profile['client_secret'], profile['refresh_token'],
+                         bool(profile.get('enabled', True)))
+                        for profile in profiles if all(profile.get(field) for field in cls.fields[:4])
+                    ]
+                )
+                cls._connection.commit()
+        return cls._connection
+
+    @classmethod
+    def _read_file(cls):
+        """Parse profiles.json, returns None when it cannot be read so the loaded profiles are kept"""
+        try:
+            with open(PROFILES_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f).get('profiles', [])
+        except (json.JSONDecodeError, OSError, AttributeError) as e:
+            print(f"Error loading profiles: {e}")
+            return None
+
+    @classmethod
+    def _get_version(cls):
+        if PROFILE_STORE == 'sqlite':
+            # Changes when another connection (e.g. auth.py or the sqlite3 shell) commits
+            return cls._get_connection().execute('PRAGMA data_version').fetchone()[0]
+        try:
+            stat = os.stat(PROFILES_FILE)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    @classmethod
+    def _load(cls, version):
+        if PROFILE_STORE == 'sqlite':
+            rows = cls._get_connection().execute('SELECT * FROM profiles ORDER BY name').fetchall()
+            profiles = [{**dict(row), 'enabled': bool(row['enabled'])} for row in rows]
+        elif version is None:
+            profiles = []
+        else:
+            profiles = cls._read_file()
+            if profiles is None:
+                return
+        profiles = [profile for profile in profiles if all(profile.get(field) for field in cls.fields[:4])]
+
+        # If no profiles found, create default profile from env vars (backward compatibility)
+        if not profiles and (CLIENT_ID and CLIENT_SECRET and REFRESH_TOKEN):
+            profiles = [{
+                'name': 'default',
+                'client_id': CLIENT_ID,
+                'client_secret': CLIENT_SECRET,
+                'refresh_token': REFRESH_TOKEN,
+                'enabled': True
+            }]
+        if cls._snapshot is not None:
+            getLogger('uvicorn').info(f'Profiles reloaded: {len(profiles)} profile(s)')
+        cls._snapshot = ProfileSnapshot(profiles, version)
+
+    @classmethod
+    def get_snapshot(cls) -> ProfileSnapshot:
+        """Current profiles, re-checking the source for changes at most every PROFILE_RELOAD_INTERVAL seconds"""
+        now = time.monotonic()
+        if cls._snapshot is None or now - cls._checked_at >= PROFILE_RELOAD_INTERVAL:
+            with cls._lock:
+                cls._checked_at = now
+                version = cls._get_version()
+                if cls._snapshot is None or version != cls._snapshot.version:
+                    cls._load(version)
+        return cls._snapshot
+
+    @classmethod
+    def get_enabled(cls) -> list:
+        return cls.get_snapshot().enabled
+
+    @classmethod
+    def get(cls, name: str):
+        """Look up a profile by its name or the hashed name shown in responses"""
+        snapshot = cls.get_snapshot()
+        return snapshot.by_name.get(name) or snapshot.by_display_name.get(name)
+
+    @classmethod
+    def get_by_client_id(cls, client_id: str) -> list:
+        return cls.get_snapshot().by_client_id.get(client_id, [])
+
+    @classmethod
+    def set_enabled(cls, name: str, enabled: bool) -> bool:
+        """Enable or disable a profile in its source, returns False for unknown profiles"""
+        profile = cls.get(name)
+        if profile is None:
+            return False
+        with cls._lock:
+            if PROFILE_STORE == 'sqlite':
+                connection = cls._get_connection()
+                updated = connection.execute(
+                    'UPDATE profiles SET enabled = ? WHERE name = ?', (enabled, profile['name'])
+                ).rowcount
+                connection.commit()
+                if not updated:
+                    return False
+            else:
+                with open(PROFILES_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                entries = [entry for entry in data.get('profiles', []) if entry.get('name') == profile['name']]
+                # The default profile built from environment variables has no entry to change
+                if not entries:
+                    return False
+                for entry in entries:
+                    entry['enabled'] = enabled
+                cls._write_file(data)
+            # Our own write is picked up right away instead of after the next interval
+            cls._load(cls._get_version())
+        return True
+
+    @classmethod
+    def _write_file(cls, data: dict):
+        """Atomically rewrite profiles.json, only the owner may read the secrets and tokens it holds"""
+        temp_path = f"{PROFILES_FILE}.tmp"
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, PROFILES_FILE)
+
+    @classmethod
+    def merge(cls, profiles: list) -> dict:
+        """Add profiles or replace the credentials of existing ones with the same name, in one atomic write"""
+        added = updated = 0
+        with cls._lock:
+            if PROFILE_STORE == 'sqlite':
+                connection = cls._get_connection()
+                for profile in profiles:
+                    exists = connection.execute('SELECT 1 FROM profiles WHERE name = ?', (profile['name'],)).fetchone()
+                    # A re-onboarded account keeps its enabled flag
+                    connection.execute(
+                        'INSERT INTO profiles (name, client_id, client_secret, refresh_token, enabled) VALUES (?, ?, ?, ?, ?) '
+                        'ON CONFLICT(name) DO UPDATE SET client_id = excluded.client_id, '
+                        'client_secret = excluded.client_secret, refresh_token = excluded.refresh_token',
+                        (profile['name'], profile['client_id'], profile['client_secret'], profile['refresh_token'],
+                         bool(profile.get('enabled', True)))
+                    )
+                    updated += bool(exists)
+                    added += not exists
+                connection.commit()
+            else:
+                data = {'profiles': []}
+                if os.path.exists(PROFILES_FILE):
+                    with open(PROFILES_FILE, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                entries = {entry.get('name'): entry for entry in data.setdefault('profiles', [])}
+                for profile in profiles:
+                    if profile['name'] in entries:
+                        entries[profile['name']].update(
+                            {field: profile[field] for field in cls.fields[1:4]}
+                        )
+                        updated += 1
+                    else:
+                        data['profiles'].append({field: profile.get(field, True) for field in cls.fields})
+                        entries[profile['name']] = data['profiles'][-1]
+                        added += 1
+                cls._write_file(data)
+            cls._load(cls._get_version())
+        return {'added': added, 'updated': updated}
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls._connection is not None:
+                cls._connection.close()
+                cls._connection = None
+
+class WorkerPool:
+    """Jobs take their task id as last argument, it is how they are found again for cancellation"""
+    _queue = None
+    _workers = []
+    _active_jobs = 0
+    # Hashed task id (as shown in responses) to the raw id of jobs not picked up yet, and to running job tasks
+    _queued = {}
+    _running = {}
+    _cancelled = set()
+    _draining = False
+    _stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'timed_out': 0}
+
+    @classmethod
+    def start(cls, worker_count: int = None, queue_size: int = None):
+        """Create the job queue and spawn the workers that drain it"""
+        if cls._workers:
+            return
+        cls._draining = False
+        cls._queue = asyncio.Queue(maxsize=queue_size or JOB_QUEUE_SIZE)
+        cls._workers = [
+            asyncio.create_task(cls._worker()) for _ in range(worker_count or WORKER_COUNT)
+        ]
+
+    @classmethod
+    async def stop(cls):
+        for worker in cls._workers:
+            worker.cancel()
+        await gather(*cls._workers, return_exceptions=True)
+        cls._workers = []
+
+    @classmethod
+    async def drain(cls, grace_period: float):
+        """Stop taking jobs, let the queued and running ones finish within grace_period, then cancel the rest"""
+        cls._draining = True
+        if cls._queue is None or not cls._workers:
+            return
+        try:
+            await asyncio.wait_for(cls._queue.join(), grace_period)
+        except asyncio.TimeoutError:
+            for key in list(cls._queued) + list(cls._running):
+                cls.cancel(key, 'Server shutting down')
+            try:
+                # Cancelled jobs only have to record their state, this does not take long
+                await asyncio.wait_for(cls._queue.join(), 5)
+            except asyncio.TimeoutError:
+                getLogger('uvicorn').warning(f'{cls.get_pending_count()} job(s) did not stop in time')
+
+    @classmethod
+    async def _worker(cls):
+        logger = getLogger('uvicorn')
+        while True:
+            job, args = await cls._queue.get()
+            key = TaskManager._encrypt_task_id(args[-1]) if args else None
+            cls._queued.pop(key, None)
+            if key in cls._cancelled:
+                # Cancelled while queued, its state was recorded then
+                cls._cancelled.discard(key)
+                cls._queue.task_done()
+                continue
+
+            cls._active_jobs += 1
+            job_deadline.set(time.monotonic() + TASK_DEADLINE if TASK_DEADLINE else None)
+            job_task = asyncio.create_task(job(*args))
+            cls._running[key] = job_task
+            try:
+                done, _ = await asyncio.wait({job_task}, timeout=TASK_DEADLINE or None)
+                if not done:
+                    cls._stats['timed_out'] += 1
+                    cls.cancel(key, f'Deadline of {TASK_DEADLINE} seconds exceeded')
+                await job_task
+                cls._stats['completed'] += 1
+            except asyncio.CancelledError:
+                if key not in cls._cancelled:
+                    # The worker itself is being stopped
+                    job_task.cancel()
+                    raise
+                cls._cancelled.discard(key)
+                cls._stats['cancelled'] += 1
+                logger.warning(f'Job {job.__name__} was cancelled')
+            except Exception as e:
+                cls._stats['failed'] += 1
+                logger.error(f'Job {job.__name__} failed: {e}')
+            finally:
+                cls._running.pop(key, None)
+                cls._active_jobs -= 1
+                cls._queue.task_done()
+                if cls.get_pending_count() == 0:
+                    # The last job may still have been uploading logs after its task finished
+                    TaskEvents.publish({'status': 'idle', 'timestamp': datetime.now().isoformat()})
+
+    @classmethod
+    def submit(cls, job, *args) -> bool:
+        """Queue a job for the workers, returns False when the queue is full or the server is shutting down"""
+        if cls._draining:
+            cls._stats['rejected'] += 1
+            return False
+        if cls._queue is None:
+            cls.start()
+        try:
+            cls._queue.put_nowait((job, args))
+        except asyncio.QueueFull:
+            cls._stats['rejected'] += 1
+            return False
+        if args:
+            cls._queued[TaskManager._encrypt_task_id(args[-1])] = args[-1]
+        cls._stats['submitted'] += 1
+        return True
+
+    @classmethod
+    def cancel(cls, task_id: str, reason: str):
+        """Cancel a queued or running job by its (hashed) task id, returns its new state or None if not found"""
+        if task_id in cls._queued:
+            cls._cancelled.add(task_id)
+            cls._stats['cancelled'] += 1
+            TaskManager.cancel_queued_task(cls._queued.pop(task_id), reason)
+            return 'cancelled'
+        job_task = cls._running.get(task_id)
+        if job_task is None or job_task.done() or task_id in cls._cancelled:
+            return None
+        cls._cancelled.add(task_id)
+        TaskManager.set_cancel_reason(task_id, reason)
+        job_task.cancel()
+        return 'cancelling'
+
+    @classmethod
+    async def join(cls):
+        """Wait until every queued job has been processed"""
+        if cls._queue is not None:
+            await cls._queue.join()
+
+    @classmethod
+    def get_free_slots(cls) -> int:
+        if cls._queue is None:
+            return JOB_QUEUE_SIZE
+        return JOB_QUEUE_SIZE - cls._queue.qsize()
+
+    @classmethod
+    def get_pending_count(cls) -> int:
+        queued = cls._queue.qsize() if cls._queue else 0
+        return queued + cls._active_jobs
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            **cls._stats,
+            'workers': len(cls._workers),
+            'active': cls._active_jobs,
+            'queued': cls._queue.qsize() if cls._queue else 0,
+            'capacity': JOB_QUEUE_SIZE
+        }
+
+class RetryPolicy:
+    retry_status_codes = {429, 502, 503, 504}
+    _stats = {'retries': 0, 'gave_up': 0}
+
+    @classmethod
+    def _parse_retry_after(cls, value: str):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def get_delay(cls, attempt: int, response=None):
+        """Seconds to wait before the next attempt, or None if the server asked for too long a pause"""
+        retry_after = cls._parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+        if retry_after is not None:
+            if retry_after > RETRY_MAX_DELAY:
+                return None
+            # Never retry earlier than the server asked, jitter only spreads the profiles out
+            return retry_after + uniform(0, RETRY_BASE_DELAY)
+        return uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    @classmethod
+    async def execute(cls, send, before_retry=None):
+        """Await send() until it returns a non-retryable response or attempts run out, before_retry() gates each retry"""
+        response = None
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            try:
+                response = await send()
+            except Exception:
+                response = None
+            if response is not None and response.status_code not in cls.retry_status_codes:
+                return response
+
+            delay = cls.get_delay(attempt, response)
+            if attempt == RETRY_MAX_ATTEMPTS - 1 or delay is None:
+                break
+            deadline = job_deadline.get()
+            # Waiting past the task deadline only gets the task cancelled mid-sleep
+            if deadline is not None and time.monotonic() + delay > deadline:
+                break
+            cls._stats['retries'] += 1
+            await async_sleep(delay)
+            if before_retry is not None:
+                await before_retry()
+
+        cls._stats['gave_up'] += 1
+        return response
+
+    @classmethod
+    def get_stats(cls):
+        return dict(cls._stats)
+
+class TenantRateLimiter:
+    """Token bucket per tenant, profiles of one tenant share Microsoft's per-tenant throttling budget"""
+    _buckets = {}
+
+    @classmethod
+    def get_tenant(cls, access_token: str, profile_name: str = None) -> str:
+        """Tenant from the profile's tenant_id, else the token's tid claim, else the account itself"""
+        profile = ProfileStore.get(profile_name) if profile_name else None
+        if profile and profile.get('tenant_id'):
+            return profile['tenant_id']
+        try:
+            payload = access_token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+            if claims.get('tid'):
+                return claims['tid']
+        except (IndexError, ValueError, AttributeError):
+            # Personal accounts get opaque tokens without claims
+            pass
+        if profile_name:
+            return f"account:{TaskManager._encrypt_profile_name(profile_name)}"
+        return f"account:{hashlib.md5((access_token or '').encode()).hexdigest()[:8]}"
+
+    @classmethod
+    def _get_bucket(cls, tenant: str) -> dict:
+        bucket = cls._buckets.get(tenant)
+        if bucket is None:
+            bucket = cls._buckets[tenant] = {
+                'rate': RATE_LIMIT_INITIAL,
+                'tokens': RATE_LIMIT_BURST,
+                'updated': time.monotonic(),
+                'requests': 0,
+                'throttled': 0
+            }
+        return bucket
+
+    @classmethod
+    async def wait(cls, tenant: str, retry: bool = False):
+        """Wait for the tenant's next request slot, retries take one as well"""
+        with Tracer.span('rate_limit', mode=RATE_LIMIT_MODE, retry=retry):
+            if RATE_LIMIT_MODE != 'adaptive':
+                await async_sleep(TIME_DELAY)
+                return
+            bucket = cls._get_bucket(tenant)
+            now = time.monotonic()
+            bucket['tokens'] = min(RATE_LIMIT_BURST, bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+            bucket['updated'] = now
+            # Going below zero reserves a slot, concurrent callers queue up behind each other in order
+            bucket['tokens'] -= 1
+            bucket['requests'] += 1
+            if bucket['tokens'] < 0:
+                await async_sleep(-bucket['tokens'] / bucket['rate'])
+
+    @classmethod
+    def record(cls, tenant: str, status_code: int = None):
+        """Additive increase on clean responses, multiplicative decrease on throttling"""
+        if RATE_LIMIT_MODE != 'adaptive':
+            return
+        bucket = cls._get_bucket(tenant)
+        if status_code in (429, 503):
+            bucket['throttled'] += 1
+            bucket['rate'] = max(RATE_LIMIT_MIN, bucket['rate'] * RATE_LIMIT_DECREASE)
+            # Drop the saved-up burst so the slower pace applies right away
+            bucket['tokens'] = min(bucket['tokens'], 0)
+        elif status_code:
+            bucket['rate'] = min(RATE_LIMIT_MAX, bucket['rate'] + RATE_LIMIT_INCREASE)
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            'mode': RATE_LIMIT_MODE,
+            'tenants': {
+                # Tenant ids are shortened like task ids, account keys are already hashed
+                tenant if tenant.startswith('account:') else tenant[:8]: {
+                    'rate': round(bucket['rate'], 2),
+                    'requests': bucket['requests'],
+                    'throttled': bucket['throttled']
+                }
+                for tenant, bucket in cls._buckets.items()
+            }
+        }
+
+class CircuitBreaker:
+    _circuits = {}
+    _stats = {'opened': 0, 'short_circuited': 0}
+
+    @classmethod
+    def make_key(cls, endpoint: str) -> str:
+        url = urlsplit(endpoint)
+        return f"{url.netloc}{url.path}"
+
+    @classmethod
+    def allow(cls, key: str) -> bool:
+        """Whether a request may be sent, lets a single probe through once the cool-down is over"""
+        circuit = cls._circuits.get(key)
+        if not circuit or circuit['opened_at'] is None:
+            return True
+        if not circuit['probing'] and time.time() - circuit['opened_at'] >= BREAKER_COOLDOWN:
+            circuit['probing'] = True
+            return True
+        cls._stats['short_circuited'] += 1
+        return False
+
+    @classmethod
+    def record(cls, key: str, response=None):
+        # Client errors are specific to a profile, only outages count against the endpoint
+        if response is not None and response.status_code < 500:
+            cls._circuits.pop(key, None)
+            return
+
+        circuit = cls._circuits.setdefault(key, {'failures': 0, 'opened_at': None, 'probing': False})
+        circuit['failures'] += 1
+        if circuit['probing'] or (circuit['opened_at'] is None and circuit['failures'] >= BREAKER_FAILURE_THRESHOLD):
+            cls._stats['opened'] += 1
+            circuit['opened_at'] = time.time()
+            circuit['probing'] = False
+
+    @classmethod
+    def release(cls, key: str):
+        """Give up a probe that ended without an answer (cancelled or failed), so the next request probes instead"""
+        circuit = cls._circuits.get(key)
+        if circuit and circuit['probing']:
+            circuit['probing'] = False
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            **cls._stats,
+            'open_circuits': [key for key, circuit in cls._circuits.items() if circuit['opened_at'] is not None]
+        }
+
+class LogUploader:
+    # Upload session chunks must be multiples of 320 KiB
+    chunk_size = 320 * 1024 * 10
+    simple_upload_limit = 4 * 1024 * 1024
+    _offsets = None
+    # Inode of the log file each offset belongs to
+    _inodes = {}
+    _locks = {}
+
+    @classmethod
+    def _load(cls):
+        cls._offsets = {}
+        cls._inodes = {}
+        if not os.path.exists(LOG_UPLOAD_STATE_FILE):
+            return
+        try:
+            with open(LOG_UPLOAD_STATE_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            cls._offsets = state.get('offsets', {})
+            cls._inodes = state.get('inodes', {})
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading log upload state: {e}")
+
+    @classmethod
+    def _save(cls):
+        temp_path = f"{LOG_UPLOAD_STATE_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'offsets': cls._offsets, 'inodes': cls._inodes}, f)
+        os.replace(temp_path, LOG_UPLOAD_STATE_FILE)
+
+    @classmethod
+    def get_lock(cls, key: str):
+        if key not in cls._locks:
+            cls._locks[key] = asyncio.Lock()
+        return cls._locks[key]
+
+    @classmethod
+    def get_pending_range(cls, key: str, log_file_path: str):
+        """Return the (start, end) byte range of the log that was not uploaded for this key and the file's inode"""
+        if cls._offsets is None:
+            cls._load()
+        stat = os.stat(log_file_path)
+        offset = cls._offsets.get(key, 0)
+        # Another inode means the log was rotated (possibly to a file that already grew past the offset),
+        # a smaller file than the shipped offset means it was truncated
+        inode = cls._inodes.get(key)
+        if (inode is not None and inode != stat.st_ino) or offset > stat.st_size:
+            offset = 0
+        return offset, stat.st_size, stat.st_ino
+
+    @classmethod
+    async def mark_uploaded(cls, key: str, offset: int, inode: int):
+        cls._offsets[key] = offset
+        cls._inodes[key] = inode
+        try:
+            await asyncio.to_thread(cls._save)
+        except OSError as e:
+            print(f"Error saving log upload state: {e}")
+
+    @classmethod
+    def read_range(cls, path: str, start: int, length: int) -> bytes:
+        with open(path, 'rb') as file:
+            file.seek(start)
+            return file.read(length)
+
+class LogIndex:
+    text_line = re.compile(rb'^\[([^\]]+)\]\[[^\]]*\]\[[^\]]*\](?:\[([^\]]+)\])? -> ')
+    _indexed_size = 0
+    _indexed_inode = None
+    _task_offsets = {}
+    _time_offsets = []
+    _time_values = []
+    _lock = None
+
+    @classmethod
+    def _reset(cls):
+        cls._indexed_size = 0
+        cls._indexed_inode = None
+        cls._task_offsets = {}
+        cls._time_offsets = []
+        cls._time_values = []
+
+    @classmethod
+    def _parse_line(cls, line: bytes):
+        """Return (timestamp, task_id) of a log line, either may be None"""
+        if line.startswith(b'{'):
+            try:
+                entry = json.loads(line)
+                return datetime.fromisoformat(entry['timestamp']).timestamp(), entry.get('task_id')
+            except (ValueError, KeyError, TypeError):
+                return None, None
+        match = cls.text_line.match(line)
+        if not match:
+            return None, None
+        try:
+            timestamp = datetime.strptime(match.group(1).decode(), '%d/%m/%Y %H:%M:%S').timestamp()
+        except ValueError:
+            timestamp = None
+        task_id = match.group(2).decode() if match.group(2) else None
+        return timestamp, task_id
+
+    @classmethod
+    def refresh(cls, log_file_path: str):
+        """Index the lines appended since the last call"""
+        stat = os.stat(log_file_path)
+        size = stat.st_size
+        if stat.st_ino != cls._indexed_inode or size < cls._indexed_size:
+            # Rotated (a new file, even one that already grew past the indexed size) or truncated, start over
+            cls._reset()
+            cls._indexed_inode = stat.st_ino
+        if size == cls._indexed_size:
+            return
+
+        with open(log_file_path, 'rb') as file:
+            file.seek(cls._indexed_size)
+            offset = cls._indexed_size
+            for line in file:
+                if not line.endswith(b'\n'):
+                    # Partially written line, index it on the next refresh
+                    break
+                timestamp, task_id = cls._parse_line(line)
+                if task_id:
+                    cls._task_offsets.setdefault(task_id, []).append(offset)
+                # The time index only needs one entry per distinct second
+                if timestamp is not None and (not cls._time_values or timestamp > cls._time_values[-1]):
+                    cls._time_values.append(timestamp)
+                    cls._time_offsets.append(offset)
+                offset += len(line)
+            cls._indexed_size = offset
+
+    @classmethod
+    def _read_filtered(cls, log_file_path: str, task_id: str, since: float, tail: int):
+        if tail is not None and tail <= 0:
+            # Same as read_tail, asking for no lines returns none rather than the whole log
+            return b''
+        cls.refresh(log_file_path)
+        since_offset = 0
+        if since is not None:
+            position = bisect_left(cls._time_values, since)
+            since_offset = cls._time_offsets[position] if position < len(cls._time_offsets) else cls._indexed_size
+
+        with open(log_file_path, 'rb') as file:
+            if not task_id:
+                file.seek(since_offset)
+                lines = file.read(cls._indexed_size - since_offset).splitlines(keepends=True)
+                return b''.join(lines[-tail:] if tail is not None else lines)
+
+            offsets = cls._task_offsets.get(task_id, [])
+            offsets = offsets[bisect_left(offsets, since_offset):]
+            if tail is not None:
+                offsets = offsets[-tail:]
+            lines = []
+            for offset in offsets:
+                file.seek(offset)
+                lines.append(file.readline())
+            return b''.join(lines)
+
+    @classmethod
+    async def query(cls, task_id: str = None, since: float = None, tail: int = None):
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        async with cls._lock:
+            return await asyncio.to_thread(cls._read_filtered, LOG_FILE, task_id, since, tail)
+
+    @classmethod
+    def read_tail(cls, log_file_path: str, line_count: int, block_size: int = 65536) -> bytes:
+        """Read the last lines by scanning blocks backwards from the end of the file"""
+        if line_count <= 0:
+            return b''
+        with open(log_file_path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            position = file.tell()
+            data = b''
+            # One extra newline is needed because the file ends with one
+            while position > 0 and data.count(b'\n') <= line_count:
+                read_size = min(block_size, position)
+                position -= read_size
+                file.seek(position)
+                data = file.read(read_size) + data
+        return b''.join(data.splitlines(keepends=True)[-line_count:])
+
+class Histogram:
+    """Fixed-bucket histogram, observe() only bumps preallocated counters"""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = ''):
+        separator = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+class Tracer:
+    """Timed spans of the sweep stages, written as JSON lines by the logging queue's writer thread"""
+    logger = getLogger('e5.trace')
+    _profiler = None
+    _profiled_batch = None
+
+    @classmethod
+    def start_trace(cls):
+        """Sampling is decided once per task, a sampled task is traced from start to finish"""
+        trace_sampled.set(TRACE_ENABLED and random() < TRACE_SAMPLE_RATE)
+
+    @classmethod
+    def _write(cls, name: str, started_at: float, started: float, error: str = None, **attributes):
+        context = task_context.get()
+        cls.logger.info(json.dumps({
+            'timestamp': datetime.fromtimestamp(started_at).isoformat(),
+            'span': name,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            'task_id': context.get('task_id'),
+            'batch_id': context.get('batch_id'),
+            'profile': context.get('profile'),
+            'error': error,
+            **attributes
+        }))
+
+    @classmethod
+    @contextmanager
+    def span(cls, name: str, **attributes):
+        """Time the block, the yielded dict takes attributes known only once it ran"""
+        if not trace_sampled.get():
+            yield attributes
+            return
+        started_at, started = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            cls._write(name, started_at, started, error, **attributes)
+
+    @classmethod
+    def http_extensions(cls) -> dict:
+        """httpx trace hook turning TCP connects and TLS handshakes of a sampled task into spans"""
+        if not trace_sampled.get():
+            return {}
+        started = {}
+
+        async def trace(event_name: str, info: dict):
+            stage, _, phase = event_name.rpartition('.')
+            if stage not in ('connection.connect_tcp', 'connection.start_tls'):
+                return
+            if phase == 'started':
+                started[stage] = (time.time(), time.perf_counter())
+            elif stage in started:
+                error = 'failed' if phase == 'failed' else None
+                cls._write('connect', *started.pop(stage), error, stage=stage.split('.')[-1])
+
+        return {'trace': trace}
+
+    @classmethod
+    def start_profile(cls, batch_id: str):
+        """cProfile the whole process while the batch runs, one batch at a time"""
+        if not TRACE_PROFILE_DIR or cls._profiler is not None:
+            return
+        import cProfile
+        cls._profiler = cProfile.Profile()
+        cls._profiled_batch = batch_id
+        cls._profiler.enable()
+
+    @classmethod
+    def stop_profile(cls, batch_id: str):
+        if cls._profiler is None or cls._profiled_batch != batch_id:
+            return
+        cls._profiler.disable()
+        # Shard processes profile their part of the batch, the pid keeps their files apart
+        path = os.path.join(TRACE_PROFILE_DIR, f'batch-{batch_id}-{os.getpid()}.prof')
+        try:
+            os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+            cls._profiler.dump_stats(path)
+            getLogger('uvicorn').info(f'Profile of batch {batch_id} saved to {path}')
+        except OSError as e:
+            print(f'Error saving profile of batch {batch_id}: {str(e)}')
+        cls._profiler = None
+        cls._profiled_batch = None
+
+class Metrics:
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    duration_buckets = (10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+    _endpoint_latency = {}
+    _status_codes = {}
+    _token_latency = Histogram(latency_buckets)
+    _upload_latency = Histogram(latency_buckets)
+    _task_duration = Histogram(duration_buckets)
+    _batch_duration = Histogram(duration_buckets)
+    _profile_last_duration = {}
+
+    @classmethod
+    def preallocate(cls, endpoints: list):
+        for endpoint in endpoints:
+            cls._endpoint_latency.setdefault(endpoint, Histogram(cls.latency_buckets))
+
+    @classmethod
+    def observe_endpoint(cls, endpoint: str, seconds: float = None, status_code: int = None):
+        if seconds is not None:
+            histogram = cls._endpoint_latency.get(endpoint)
+            if histogram is None:
+                histogram = cls._endpoint_latency[endpoint] = Histogram(cls.latency_buckets)
+            histogram.observe(seconds)
+        key = (endpoint, status_code or 'error')
+        cls._status_codes[key] = cls._status_codes.get(key, 0) + 1
+
+    @classmethod
+    def observe_token(cls, seconds: float):
+        cls._token_latency.observe(seconds)
+
+    @classmethod
+    def observe_upload(cls, seconds: float):
+        cls._upload_latency.observe(seconds)
+
+    @classmethod
+    def observe_task(cls, seconds: float, profile_name: str = None):
+        cls._task_duration.observe(seconds)
+        if profile_name:
+            cls._profile_last_duration[TaskManager._encrypt_profile_name(profile_name)] = seconds
+
+    @classmethod
+    def observe_batch(cls, seconds: float):
+        cls._batch_duration.observe(seconds)
+
+    @classmethod
+    def _label(cls, value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def render(cls) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = [
+            '# HELP e5_endpoint_latency_seconds Latency of endpoint calls, including retries.',
+            '# TYPE e5_endpoint_latency_seconds histogram'
+        ]
+        for endpoint, histogram in list(cls._endpoint_latency.items()):
+            lines += histogram.render('e5_endpoint_latency_seconds', f'endpoint="{cls._label(endpoint)}"')
+
+        lines += [
+            '# HELP e5_endpoint_responses_total Endpoint responses by status code.',
+            '# TYPE e5_endpoint_responses_total counter'
+        ]
+        for (endpoint, status_code), count in list(cls._status_codes.items()):
+            lines.append(
+                f'e5_endpoint_responses_total{{endpoint="{cls._label(endpoint)}",code="{status_code}"}} {count}'
+            )
+
+        for name, help_text, histogram in (
+            ('e5_token_latency_seconds', 'Latency of access token requests.', cls._token_latency),
+            ('e5_upload_latency_seconds', 'Duration of OneDrive log uploads.', cls._upload_latency),
+            ('e5_task_duration_seconds', 'Duration of sweep tasks.', cls._task_duration),
+            ('e5_batch_duration_seconds', 'Duration of /call-all-profiles batches.', cls._batch_duration)
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            lines += histogram.render(name)
+
+        lines += [
+            '# HELP e5_profile_last_task_duration_seconds Duration of the last task of each profile.',
+            '# TYPE e5_profile_last_task_duration_seconds gauge'
+        ]
+        for profile, seconds in list(cls._profile_last_duration.items()):
+            lines.append(f'e5_profile_last_task_duration_seconds{{profile="{cls._label(profile)}"}} {seconds}')
+
+        pool_stats = WorkerPool.get_stats()
+        token_stats = TokenCache.get_stats()
+        for name, metric_type, value in (
+            ('e5_queue_depth', 'gauge', pool_stats['queued']),
+            ('e5_active_jobs', 'gauge', pool_stats['active']),
+            ('e5_running_tasks', 'gauge', TaskManager.get_running_tasks_count()),
+            ('e5_jobs_rejected_total', 'counter', pool_stats['rejected']),
+            ('e5_token_cache_hits_total', 'counter', token_stats['hits']),
+            ('e5_token_cache_misses_total', 'counter', token_stats['misses']),
+            ('e5_retries_total', 'counter', RetryPolicy.get_stats()['retries']),
+            ('e5_circuit_breaker_opened_total', 'counter', CircuitBreaker.get_stats()['opened'])
+        ):
+            lines += [f'# TYPE {name} {metric_type}', f'{name} {value}']
+
+        return '\n'.join(lines) + '\n'
+
+class Scheduler:
+    _task = None
+    _last_runs = None
+    _next_runs = {}
+    # A run this late is treated as missed and spread over the catch-up window
+    late_tolerance = 60
+
+    @classmethod
+    def _load(cls):
+        cls._last_runs = {}
+        if not os.path.exists(SCHEDULE_STATE_FILE):
+            return
+        try:
+            with open(SCHEDULE_STATE_FILE, 'r', encoding='utf-8') as f:
+                cls._last_runs = json.load(f).get('last_runs', {})
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading schedule state: {e}")
+
+    @classmethod
+    def _save(cls):
+        temp_path = f"{SCHEDULE_STATE_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_runs': cls._last_runs}, f)
+        os.replace(temp_path, SCHEDULE_STATE_FILE)
+
+    @classmethod
+    def _get_key(cls, profile: dict) -> str:
+        return TaskManager._encrypt_profile_name(profile['name'])
+
+    @classmethod
+    def get_slot_offsets(cls, profiles: list) -> dict:
+        """Spread profiles evenly over the interval, ordered and jittered by a stable hash of their name"""
+        hashes = sorted(
+            (int(hashlib.md5(profile['name'].encode()).hexdigest(), 16), cls._get_key(profile))
+            for profile in profiles
+        )
+        slot_width = SCHEDULE_INTERVAL / max(1, len(hashes))
+        return {
+            key: index * slot_width + (profile_hash % 1000) / 1000 * slot_width * 0.5
+            for index, (profile_hash, key) in enumerate(hashes)
+        }
+
+    @classmethod
+    def _next_slot_after(cls, slot_offset: float, earliest: float) -> float:
+        cycles = -(-(earliest - slot_offset) // SCHEDULE_INTERVAL)
+        return cycles * SCHEDULE_INTERVAL + slot_offset
+
+    @classmethod
+    def _plan(cls, slot_offsets: dict, now: float):
+        for key, slot_offset in slot_offsets.items():
+            if key in cls._next_runs:
+                continue
+            last_run = cls._last_runs.get(key)
+            # First slot at least half an interval after the last run, profiles that never ran are overdue
+            next_run = cls._next_slot_after(slot_offset, last_run + SCHEDULE_INTERVAL / 2) if last_run else 0
+            if next_run < now - cls.late_tolerance:
+                # Missed while the process was down, catch up without a thundering herd
+                next_run = now + slot_offset / SCHEDULE_INTERVAL * SCHEDULE_CATCH_UP_WINDOW
+            cls._next_runs[key] = next_run
+        for key in set(cls._next_runs) - set(slot_offsets):
+            del cls._next_runs[key]
+
+    @classmethod
+    async def _run_profile(cls, profile: dict, task_id: str):
+        await HTTPClient.call_endpoints_for_profile(profile, task_id)
+        cls._last_runs[cls._get_key(profile)] = time.time()
+        try:
+            await asyncio.to_thread(cls._save)
+        except OSError as e:
+            print(f"Error saving schedule state: {e}")
+
+    @classmethod
+    async def _loop(cls):
+        logger = getLogger('uvicorn')
+        while True:
+            now = time.time()
+            profiles = {cls._get_key(profile): profile for profile in ProfileStore.get_enabled()}
+            slot_offsets = cls.get_slot_offsets(list(profiles.values()))
+            cls._plan(slot_offsets, now)
+
+            due = [key for key, next_run in cls._next_runs.items() if next_run <= now]
+            if due:
+                import uuid
+                batch_id = str(uuid.uuid4())[:8]
+                for key in due:
+                    profile = profiles[key]
+                    task_id = f"{batch_id}-{profile['name']}"
+                    flight_key = TokenCache.make_key(profile['refresh_token'], profile['client_id'], profile['name'])
+                    if SingleFlight.get_task(flight_key):
+                        # A manual run of this profile is in flight, it counts as this slot's run
+                        cls._next_runs[key] = cls._next_slot_after(slot_offsets[key], now + SCHEDULE_INTERVAL / 2)
+                        continue
+                    SingleFlight.register(flight_key, task_id)
+                    TaskManager.queue_task(task_id)
+                    if not WorkerPool.submit(cls._run_profile, profile, task_id):
+                        # Never started, so it must not be counted off the running tasks
+                        TaskManager._close_task(task_id, 'failed', 'Job queue is full')
+                        logger.warning(f'Scheduler: queue full, skipped profile {key}')
+                    # Finished or not, the next attempt is the profile's next slot
+                    cls._next_runs[key] = cls._next_slot_after(slot_offsets[key], now + SCHEDULE_INTERVAL / 2)
+                logger.info(f'Scheduler: started {len(due)} profile task(s) in batch {batch_id}')
+
+            upcoming = min(cls._next_runs.values(), default=now + 60)
+            await async_sleep(min(60, max(1, upcoming - time.time())))
+
+    @classmethod
+    def start(cls):
+        if cls._task is None:
+            cls._load()
+            cls._task = asyncio.create_task(cls._loop())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            await gather(cls._task, return_exceptions=True)
+            cls._task = None
+
+    @classmethod
+    def get_stats(cls):
+        now = time.time()
+        return {
+            'enabled': cls._task is not None,
+            'interval': SCHEDULE_INTERVAL,
+            'scheduled_profiles': len(cls._next_runs),
+            'next_run_in': round(min(cls._next_runs.values()) - now, 1) if cls._next_runs else None
+        }
+
+class EndpointPlanner:
+    path = ENDPOINT_PLAN_FILE
+    # Answers that mean the tenant or account cannot use the endpoint, retrying them next run will not help
+    permanent_status_codes = {401, 403, 404}
+    _profiles = None
+    _dirty = False
+    _flush_task = None
+    # The background flush and a final flush run in worker threads and must not interleave
+    _write_lock = threading.Lock()
+    _stats = {'planned': 0, 'skipped': 0, 'probed': 0, 'demoted': 0, 'promoted': 0, 'account_failures': 0}
+
+    @classmethod
+    def use_file(cls, path: str):
+        cls.path = path
+        cls._profiles = None
+
+    @classmethod
+    def _read(cls, path: str) -> dict:
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('profiles', {})
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading endpoint plan: {e}")
+            return {}
+
+    @classmethod
+    def _get_profiles(cls) -> dict:
+        if cls._profiles is None:
+            cls._profiles = cls._read(cls.path)
+        return cls._profiles
+
+    @classmethod
+    def _save(cls, profiles: dict):
+        with cls._write_lock:
+            temp_path = f"{cls.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'profiles': profiles}, f)
+            os.replace(temp_path, cls.path)
+
+    @classmethod
+    def persist(cls):
+        """Mark the plan changed, a background task writes it once per ENDPOINT_PLAN_FLUSH_INTERVAL"""
+        cls._dirty = True
+        if cls._flush_task is None or cls._flush_task.done():
+            cls._flush_task = asyncio.get_running_loop().create_task(cls._flush_later())
+
+    @classmethod
+    async def _flush_later(cls):
+        await async_sleep(ENDPOINT_PLAN_FLUSH_INTERVAL)
+        await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        """Write pending changes now, called when a run ends and on shutdown"""
+        if not cls._dirty:
+            return
+        cls._dirty = False
+        # Copied on the loop, record() keeps changing the entries while the thread serializes them
+        profiles = {
+            key: {endpoint: dict(entry) for endpoint, entry in entries.items()}
+            for key, entries in cls._get_profiles().items()
+        }
+        try:
+            await asyncio.to_thread(cls._save, profiles)
+        except OSError as e:
+            cls._dirty = True
+            print(f"Error saving endpoint plan: {e}")
+
+    @classmethod
+    def get_key(cls, profile_name: str) -> str:
+        return TaskManager._encrypt_profile_name(profile_name)
+
+    @classmethod
+    def _is_probe_due(cls, entry: dict, now: float) -> bool:
+        return now - max(entry['demoted_at'], entry.get('probed_at') or 0) >= ENDPOINT_REPROBE_INTERVAL
+
+    @classmethod
+    def build(cls, profile_name: str, endpoints: list) -> list:
+        """Endpoints to call this run: the ones not known to fail, within budget, plus a few due re-probes"""
+        entries = cls._get_profiles().get(cls.get_key(profile_name), {})
+        now = time.time()
+        healthy, probes = [], []
+        for endpoint in endpoints:
+            entry = entries.get(endpoint)
+            if not entry or not entry.get('demoted_at'):
+                healthy.append(endpoint)
+            elif cls._is_probe_due(entry, now):
+                probes.append(endpoint)
+
+        # Endpoints are shuffled by the caller, so a budget rotates through the healthy ones across runs
+        if ENDPOINT_PLAN_BUDGET:
+            healthy = healthy[:ENDPOINT_PLAN_BUDGET]
+        probes = probes[:ENDPOINT_PROBE_LIMIT]
+        cls._stats['planned'] += len(healthy)
+        cls._stats['probed'] += len(probes)
+        cls._stats['skipped'] += len(endpoints) - len(healthy) - len(probes)
+        return healthy + probes
+
+    @classmethod
+    def record(cls, profile_name: str, results: dict):
+        """Update the profile's endpoint history with the outcome of a sweep"""
+        status_codes = {result['status_code'] for result in results.values()}
+        if len(results) > 1 and len(status_codes) == 1 and status_codes <= cls.permanent_status_codes:
+            # Every endpoint refused with the same code: the account or its consent is broken, not the endpoints
+            cls._stats['account_failures'] += 1
+            return
+
+        entries = cls._get_profiles().setdefault(cls.get_key(profile_name), {})
+        now = time.time()
+        for endpoint, result in results.items():
+            status_code = result['status_code']
+            entry = entries.setdefault(endpoint, {'failures': 0, 'demoted_at': None})
+            entry['status_code'] = status_code
+            if status_code in cls.permanent_status_codes:
+                entry['failures'] += 1
+                if entry['demoted_at']:
+                    entry['probed_at'] = now
+                elif entry['failures'] >= ENDPOINT_DEMOTE_AFTER:
+                    entry['demoted_at'] = now
+                    cls._stats['demoted'] += 1
+            elif status_code and status_code < 400:
+                if entry['demoted_at']:
+                    cls._stats['promoted'] += 1
+                entry.update({'failures': 0, 'demoted_at': None, 'probed_at': None})
+            # Throttling, server errors and timeouts say nothing about access, the circuit breaker handles those
+
+    @classmethod
+    def get_plan(cls, profile_name: str, endpoints: list):
+        """Endpoint states of a profile, read from the shard that owns it when sharding is on"""
+        key = cls.get_key(profile_name)
+        if SHARD_COUNT > 1:
+            entries = cls._read(f"{ENDPOINT_PLAN_FILE}.shard{ShardRunner.get_shard_index(profile_name)}").get(key, {})
+        else:
+            entries = cls._get_profiles().get(key, {})
+        now = time.time()
+        plan = []
+        for endpoint in endpoints:
+            entry = entries.get(endpoint, {})
+            if not entry.get('demoted_at'):
+                state = 'active'
+            else:
+                state = 'probe' if cls._is_probe_due(entry, now) else 'demoted'
+            plan.append({
+                'endpoint': endpoint,
+                'state': state,
+                'status_code': entry.get('status_code'),
+                'failures': entry.get('failures', 0),
+                'demoted_at': entry.get('demoted_at'),
+                'next_probe_at': (
+                    max(entry['demoted_at'], entry.get('probed_at') or 0) + ENDPOINT_REPROBE_INTERVAL
+                    if entry.get('demoted_at') else None
+                )
+            })
+        return {
+            'profile': key,
+            'budget': ENDPOINT_PLAN_BUDGET or len(endpoints),
+            'active_count': sum(1 for entry in plan if entry['state'] == 'active'),
+            'demoted_count': sum(1 for entry in plan if entry['state'] != 'active'),
+            'endpoints': plan
+        }
+
+    @classmethod
+    def get_stats(cls):
+        return {**cls._stats, 'enabled': ENDPOINT_PLAN_ENABLED}
+
+class TokenCache:
+    path = TOKEN_CACHE_FILE
+    _entries = {}
+    _loaded = False
+    _dirty = False
+    _flush_task = None
+    # Writes run in worker threads, the background flush and a final flush must not interleave
+    _write_lock = threading.Lock()
+    _stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'rotations': 0}
+
+    @classmethod
+    def make_key(cls, refresh_token: str, client_id: str, profile_name: str = None) -> str:
+        """Build the cache key for a profile/client pair"""
+        # Ad-hoc /call requests have no profile name, so the refresh token identifies the account
+        owner = profile_name or hashlib.md5((refresh_token or '').encode()).hexdigest()[:8]
+        return f"{owner}:{client_id}"
+
+    @classmethod
+    def _fingerprint(cls, refresh_token: str) -> str:
+        return hashlib.md5((refresh_token or '').encode()).hexdigest()
+
+    @classmethod
+    def use_file(cls, path: str):
+        """Switch to another cache file, entries are read from it on the next lookup"""
+        cls.path = path
+        cls._entries = {}
+        cls._loaded = False
+
+    @classmethod
+    def _load(cls):
+        cls._loaded = True
+        # A shard without its own file yet starts from the shared cache
+        path = cls.path if os.path.exists(cls.path) else TOKEN_CACHE_FILE
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                cls._entries = json.load(f).get('entries', {})
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading token cache: {e}")
+            cls._entries = {}
+
+    @classmethod
+    def _save(cls):
+        with cls._write_lock:
+            # Copying the dict is atomic, so the latest entries are written even while tokens are being stored
+            entries = dict(cls._entries)
+            temp_path = f"{cls.path}.tmp"
+            # The file holds refresh and access tokens, only the owner may read it
+            descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+                json.dump({'entries': entries}, f)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, cls.path)
+
+    @classmethod
+    def persist(cls):
+        """Mark the cache changed, a background task writes it once per TOKEN_CACHE_FLUSH_INTERVAL"""
+        cls._dirty = True
+        if cls._flush_task is None or cls._flush_task.done():
+            cls._flush_task = asyncio.get_running_loop().create_task(cls._flush_later())
+
+    @classmethod
+    async def _flush_later(cls):
+        await async_sleep(TOKEN_CACHE_FLUSH_INTERVAL)
+        await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        """Write pending changes now, called when a run ends and on shutdown"""
+        if not cls._dirty:
+            return
+        cls._dirty = False
+        try:
+            await asyncio.to_thread(cls._save)
+        except OSError as e:
+            cls._dirty = True
+            print(f"Error saving token cache: {e}")
+
+    @classmethod
+    def get_access_token(cls, key: str, refresh_token: str):
+        """Return a cached access token that is still valid, or None"""
+        if not cls._loaded:
+            cls._load()
+        entry = cls._entries.get(key)
+        if (
+            entry
+            and entry.get('seed') == cls._fingerprint(refresh_token)
+            and entry.get('access_token')
+            and entry.get('expires_at', 0) - TOKEN_EXPIRY_MARGIN > time.time()
+        ):
+            cls._stats['hits'] += 1
+            return entry['access_token']
+        cls._stats['misses'] += 1
+        return None
+
+    @classmethod
+    def get_refresh_token(cls, key: str, refresh_token: str) -> str:
+        """Return the latest rotated refresh token for this key, falling back to the configured one"""
+        if not cls._loaded:
+            cls._load()
+        entry = cls._entries.get(key)
+        # A changed configured token means the operator re-authorized, so the stored rotation is stale
+        if entry and entry.get('seed') == cls._fingerprint(refresh_token) and entry.get('refresh_token'):
+            return entry['refresh_token']
+        return refresh_token
+
+    @classmethod
+    def store(cls, key: str, refresh_token: str, token_response: dict):
+        rotated_token = token_response.get('refresh_token')
+        previous = cls._entries.get(key, {})
+        if rotated_token and rotated_token != previous.get('refresh_token', refresh_token):
+            cls._stats['rotations'] += 1
+        cls._stats['refreshes'] += 1
+        cls._entries[key] = {
+            'seed': cls._fingerprint(refresh_token),
+            'access_token': token_response['access_token'],
+            'expires_at': time.time() + int(token_response.get('expires_in', 3600)),
+            'refresh_token': rotated_token or previous.get('refresh_token') or refresh_token
+        }
+
+    @classmethod
+    def invalidate(cls, key: str):
+        cls._entries.pop(key, None)
+
+    @classmethod
+    def get_stats(cls):
+        lookups = cls._stats['hits'] + cls._stats['misses']
+        return {
+            **cls._stats,
+            'hit_rate': round(cls._stats['hits'] / lookups, 3) if lookups else 0.0,
+            'cached_tokens': len(cls._entries)
+        }
+
+class UpstreamOverrideTransport(AsyncBaseTransport):
+    """Sends every request to UPSTREAM_BASE_URL instead of Microsoft, used with mock_graph.py"""
+
+    def __init__(self, transport: AsyncHTTPTransport):
+        self.transport = transport
+        self.upstream = URL(UPSTREAM_BASE_URL)
+
+    async def handle_async_request(self, request):
+        request.headers['X-Forwarded-Host'] = request.url.host
+        request.url = request.url.copy_with(
+            scheme=self.upstream.scheme, host=self.upstream.host, port=self.upstream.port
+        )
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class HTTPTransport:
+    # Each host gets its own connection pool so one busy service cannot starve the others
+    hosts = ['login.microsoftonline.com', 'graph.microsoft.com', 'api.powerbi.com']
+    _ssl_context = None
+
+    @classmethod
+    def _get_ssl_context(cls):
+        """One SSL context for every pool, loading the CA bundle is the slow part of building a transport"""
+        if cls._ssl_context is None:
+            cls._ssl_context = ssl.create_default_context()
+        return cls._ssl_context
+
+    @classmethod
+    def _http2_available(cls) -> bool:
+        if not HTTP2_ENABLED:
+            return False
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            print('HTTP/2 disabled: install httpx[http2] to enable it')
+            return False
+
+    @classmethod
+    def _timeout(cls):
+        return Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+
+    @classmethod
+    def _transport(cls, max_connections: int, http2: bool):
+        transport = AsyncHTTPTransport(
+            verify=cls._get_ssl_context(),
+            http2=http2,
+            limits=Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=min(max_connections, HTTP_MAX_KEEPALIVE_CONNECTIONS),
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+        return UpstreamOverrideTransport(transport) if UPSTREAM_BASE_URL else transport
+
+    @classmethod
+    def create_client(cls):
+        """Client for token and API calls, multiplexed over HTTP/2 where available"""
+        http2 = cls._http2_available()
+        return httpx_client(
+            verify=cls._get_ssl_context(),
+            http2=http2,
+            timeout=cls._timeout(),
+            limits=Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            mounts={
+                f'all://{host}': cls._transport(HTTP_HOST_MAX_CONNECTIONS, http2)
+                for host in cls.hosts
+            }
+        )
+
+    @classmethod
+    def create_upload_client(cls):
+        """Separate small pool for OneDrive uploads"""
+        return httpx_client(
+            verify=cls._get_ssl_context(),
+            timeout=cls._timeout(),
+            transport=cls._transport(HTTP_UPLOAD_MAX_CONNECTIONS, False)
+        )
+
+class HTTPClient:
+    instance = HTTPTransport.create_client()
+    upload_instance = HTTPTransport.create_upload_client()
+    upload_logs = UPLOAD_LOGS_TO_ONEDRIVE
+    token_endpoint = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
+    graph_endpoints = [
+            'https://graph.microsoft.com/v1.0/me/drive/root',
+            'https://graph.microsoft.com/v1.0/me/drive',
+            'https://graph.microsoft.com/v1.0/drive/root',
+            'https://graph.microsoft.com/v1.0/users',
+            'https://graph.microsoft.com/v1.0/me/messages',
+            'https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messageRules',
+            'https://graph.microsoft.com/v1.0/me/drive/root/children',
+            'https://api.powerbi.com/v1.0/myorg/apps',
+            'https://graph.microsoft.com/v1.0/me/mailFolders',
+            'https://graph.microsoft.com/v1.0/me/outlook/masterCategories',
+            'https://graph.microsoft.com/v1.0/applications?$count=true',
+            'https://graph.microsoft.com/v1.0/me/?$select=displayName,skills',
+            'https://graph.microsoft.com/v1.0/me/mailFolders/Inbox/messages/delta',
+            'https://graph.microsoft.com/beta/me/outlook/masterCategories',
+            'https://graph.microsoft.com/beta/me/messages?$select=internetMessageHeaders&$top=1',
+            'https://graph.microsoft.com/v1.0/sites/root/lists',
+            'https://graph.microsoft.com/v1.0/sites/root',
+            'https://graph.microsoft.com/v1.0/sites/root/drives'
+        ]
+    # Endpoints with large bodies are streamed and discarded regardless of E5_SWEEP_MODE
+    endpoint_modes = {
+        'https://graph.microsoft.com/v1.0/users': 'stream',
+        'https://graph.microsoft.com/v1.0/me/messages': 'stream',
+        'https://graph.microsoft.com/v1.0/me/mailFolders/Inbox/messages/delta': 'stream',
+        'https://graph.microsoft.com/v1.0/sites/root/lists': 'stream',
+        'https://graph.microsoft.com/v1.0/me/drive/root/children': 'stream'
+    }
+    trimmed_collections = {
+        '/v1.0/users',
+        '/v1.0/me/messages',
+        '/v1.0/me/mailFolders',
+        '/v1.0/me/drive/root/children',
+        '/v1.0/sites/root/lists',
+        '/v1.0/sites/root/drives'
+    }
+
+    @classmethod
+    async def acquire_access_token(
+        cls,
+        refresh_token:str = None,
+        client_id:str = None,
+        client_secret:str = None,
+        profile_name:str = None
+    ):
+        refresh_token = refresh_token or REFRESH_TOKEN
+        client_id = client_id or CLIENT_ID
+        client_secret = client_secret or CLIENT_SECRET
+
+        cache_key = TokenCache.make_key(refresh_token, client_id, profile_name)
+        access_token = TokenCache.get_access_token(cache_key, refresh_token)
+        if access_token:
+            return access_token
+
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': TokenCache.get_refresh_token(cache_key, refresh_token),
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'redirect_uri': 'http://localhost:53682/'
+        }
+
+        started = time.perf_counter()
+        response = await cls.instance.post(
+            cls.token_endpoint, headers=headers, data=data, extensions=Tracer.http_extensions()
+        )
+        token_response = response.json()
+
+        if not token_response.get('access_token') and data['refresh_token'] != refresh_token:
+            # The rotated token was rejected, retry once with the configured one
+            TokenCache.invalidate(cache_key)
+            data['refresh_token'] = refresh_token
+            response = await cls.instance.post(cls.token_endpoint, headers=headers, data=data)
+            token_response = response.json()
+        Metrics.observe_token(time.perf_counter() - started)
+
+        if not token_response.get('access_token'):
+            # Microsoft's error code (e.g. invalid_grant for a revoked token) tells dead accounts from outages
+            error_code = f" ({token_response['error']})" if token_response.get('error') else ''
+            ErrorHandler.abort(
+                401,
+                f'Failed to acquire the access token{error_code}. Please verify your refresh token and try again.'
+            )
+
+        TokenCache.store(cache_key, refresh_token, token_response)
+        TokenCache.persist()
+        return token_response['access_token']
+    
+    @classmethod
+    async def close(cls):
+        await cls.instance.aclose()
+        await cls.upload_instance.aclose()
+
+    @classmethod
+    def reopen(cls):
+        """Replace clients closed by a previous run, shard processes run every job on a new event loop"""
+        if cls.instance.is_closed:
+            cls.instance = HTTPTransport.create_client()
+        if cls.upload_instance.is_closed:
+            cls.upload_instance = HTTPTransport.create_upload_client()
+
+    @classmethod
+    def get_endpoint_mode(cls, endpoint: str) -> str:
+        return cls.endpoint_modes.get(endpoint, SWEEP_MODE)
+
+    @classmethod
+    def _prepare_url(cls, endpoint: str) -> str:
+        """Ask for a single item from collections swept in stream mode, the call itself is what counts"""
+        url = urlsplit(endpoint)
+        if cls.get_endpoint_mode(endpoint) != 'stream' or url.path not in cls.trimmed_collections or '$top' in url.query:
+            return endpoint
+        query = f"{url.query}&$top=1" if url.query else '$top=1'
+        return urlunsplit((url.scheme, url.netloc, url.path, query, url.fragment))
+
+    @classmethod
+    async def sweep_endpoints(cls, access_token: str, task_id: str = None, profile_name: str = None):
+        """Call every endpoint once and return the status code, size and latency of each one"""
+        endpoints = cls.graph_endpoints.copy()
+        shuffle(endpoints)
+        # Profiles learn which endpoints their tenant can use, ad-hoc /call sweeps always cover everything
+        if ENDPOINT_PLAN_ENABLED and profile_name:
+            endpoints = EndpointPlanner.build(profile_name, endpoints)
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        tenant = TenantRateLimiter.get_tenant(access_token, profile_name)
+
+        if GRAPH_BATCH_MODE:
+            results = await cls._sweep_batched(endpoints, headers, tenant)
+        else:
+            results = {}
+            for endpoint in endpoints:
+                await TenantRateLimiter.wait(tenant)
+                results[endpoint] = await cls._call_endpoint(endpoint, headers, tenant)
+
+        succeeded = sum(
+            1 for result in results.values() if result['status_code'] and result['status_code'] < 400
+        )
+        received = sum(result['bytes'] or 0 for result in results.values())
+        getLogger('uvicorn').info(
+            f'Task {TaskManager._encrypt_task_id(task_id or "-")}: '
+            f'{succeeded}/{len(results)} endpoints succeeded, {received} bytes received'
+        )
+        if ENDPOINT_PLAN_ENABLED and profile_name:
+            EndpointPlanner.record(profile_name, results)
+            EndpointPlanner.persist()
+        return results
+
+    @classmethod
+    async def _get_streamed(cls, url: str, headers: dict):
+        """GET without buffering the body, stops reading once STREAM_DRAIN_LIMIT bytes arrived"""
+        async with cls.instance.stream('GET', url, headers=headers, extensions=Tracer.http_extensions()) as response:
+            async for _ in response.aiter_raw():
+                # Leaving the block early closes the stream instead of downloading the rest
+                if response.num_bytes_downloaded >= STREAM_DRAIN_LIMIT:
+                    break
+        return response
+
+    @classmethod
+    async def _call_endpoint(cls, endpoint: str, headers: dict, tenant: str):
+        result = {'status_code': None, 'bytes': None, 'latency_ms': None}
+        breaker_key = CircuitBreaker.make_key(endpoint)
+        if not CircuitBreaker.allow(breaker_key):
+            return result
+
+        url = cls._prepare_url(endpoint)
+        if cls.get_endpoint_mode(endpoint) == 'stream':
+            request = lambda: cls._get_streamed(url, headers)
+        else:
+            request = lambda: cls.instance.get(url, headers=headers, extensions=Tracer.http_extensions())
+
+        async def send():
+            # Every attempt counts for the tenant, a 429 cleared by a retry must still slow it down
+            response = await request()
+            TenantRateLimiter.record(tenant, response.status_code)
+            return response
+
+        with Tracer.span('endpoint', endpoint=endpoint) as span:
+            started = time.perf_counter()
+            recorded = False
+            try:
+                response = await RetryPolicy.execute(send, lambda: TenantRateLimiter.wait(tenant, retry=True))
+                CircuitBreaker.record(breaker_key, response)
+                recorded = True
+            finally:
+                if not recorded:
+                    CircuitBreaker.release(breaker_key)
+            elapsed = time.perf_counter() - started
+            result['latency_ms'] = round(elapsed * 1000, 1)
+            if response is not None:
+                result['status_code'] = response.status_code
+                result['bytes'] = response.num_bytes_downloaded
+            span.update(status_code=result['status_code'], bytes=result['bytes'])
+        Metrics.observe_endpoint(endpoint, elapsed, result['status_code'])
+        return result
+
+    @classmethod
+    async def _sweep_batched(cls, endpoints: list, headers: dict, tenant: str):
+        """Pack graph.microsoft.com endpoints into $batch requests, other hosts are called directly"""
+        logger = getLogger('uvicorn')
+        results = {}
+        batches = {}
+        direct_endpoints = []
+
+        for endpoint in endpoints:
+            url = urlsplit(cls._prepare_url(endpoint))
+            if url.netloc != 'graph.microsoft.com':
+                direct_endpoints.append(endpoint)
+                continue
+            # A batch only accepts URLs relative to its own API version
+            version, _, path = url.path.lstrip('/').partition('/')
+            relative_url = f"/{path}?{url.query}" if url.query else f"/{path}"
+            batches.setdefault(version, []).append((endpoint, relative_url))
+
+        for version, items in batches.items():
+            for start in range(0, len(items), GRAPH_BATCH_SIZE):
+                chunk = items[start:start + GRAPH_BATCH_SIZE]
+                body = {
+                    'requests': [
+                        {'id': str(index), 'method': 'GET', 'url': relative_url}
+                        for index, (_, relative_url) in enumerate(chunk)
+                    ]
+                }
+                batch_url = f'{GRAPH_BATCH_BASE_URL}/{version}/$batch'
+                breaker_key = CircuitBreaker.make_key(batch_url)
+
+                async def send():
+                    response = await cls.instance.post(
+                        batch_url, headers=headers, json=body, extensions=Tracer.http_extensions()
+                    )
+                    TenantRateLimiter.record(tenant, cls._get_batch_throttle_status(response))
+                    return response
+
+                await TenantRateLimiter.wait(tenant)
+                started = time.perf_counter()
+                response = None
+                with Tracer.span('batch', version=version, requests=len(chunk)) as span:
+                    allowed = CircuitBreaker.allow(breaker_key)
+                    recorded = False
+                    try:
+                        if not allowed:
+                            raise ConnectionError(f'Circuit open for {breaker_key}')
+                        response = await RetryPolicy.execute(send, lambda: TenantRateLimiter.wait(tenant, retry=True))
+                        CircuitBreaker.record(breaker_key, response)
+                        recorded = True
+                        statuses = {
+                            item.get('id'): item.get('status')
+                            for item in response.json().get('responses', [])
+                        }
+                    except Exception:
+                        statuses = {}
+                    finally:
+                        if allowed and not recorded:
+                            CircuitBreaker.release(breaker_key)
+                    span['status_code'] = response.status_code if response is not None else None
+                elapsed = time.perf_counter() - started
+                latency_ms = round(elapsed * 1000, 1)
+                Metrics.observe_endpoint(batch_url, elapsed, response.status_code if response is not None else None)
+
+                for index, (endpoint, _) in enumerate(chunk):
+                    Metrics.observe_endpoint(endpoint, status_code=statuses.get(str(index)))
+                    # Sub-responses share one body, so only the batch latency is known
+                    results[endpoint] = {'status_code': statuses.get(str(index)), 'bytes': None, 'latency_ms': latency_ms}
+                    logger.info(f'Batch sub-request: GET {endpoint} "{results[endpoint]["status_code"]}"')
+
+        for endpoint in direct_endpoints:
+            await TenantRateLimiter.wait(tenant)
+            results[endpoint] = await cls._call_endpoint(endpoint, headers, tenant)
+
+        return results
+
+    @classmethod
+    def _get_batch_throttle_status(cls, response) -> int:
+        """Status a $batch attempt counts as for the tenant, throttled sub-requests count like a throttled batch"""
+        if response.status_code != 200:
+            return response.status_code
+        try:
+            statuses = [item.get('status') for item in response.json().get('responses', [])]
+        except (ValueError, AttributeError):
+            return response.status_code
+        return next((status for status in statuses if status in (429, 503)), response.status_code)
+
+    @classmethod
+    async def call_endpoints(cls, access_token:str, task_id: str = None):
+        import uuid
+        if not task_id:
+            task_id = str(uuid.uuid4())[:8]
+            
+        task_context.set({'task_id': task_id})
+        Tracer.start_trace()
+        TaskManager.start_task(task_id)
+        
+        try:
+            with Tracer.span('task'):
+                results = await cls.sweep_endpoints(access_token, task_id)
+                TaskManager.record_results(task_id, results)
+                
+                TaskManager.finish_task(task_id, True)
+                # Upload log file to OneDrive after successful completion
+                if cls.upload_logs:
+                    with Tracer.span('upload'):
+                        await cls.upload_log_to_onedrive(access_token)
+        except asyncio.CancelledError:
+            TaskManager.cancel_task(task_id)
+            raise
+        except Exception as e:
+            TaskManager.finish_task(task_id, False, str(e))
+            raise
+    
+    @classmethod
+    async def call_endpoints_for_profile(cls, profile: dict, task_id: str = None):
+        """Call endpoints for a specific profile"""
+        import uuid
+        if not task_id:
+            task_id = str(uuid.uuid4())[:8]
+            
+        batch_id = TaskManager._get_batch_id(task_id)
+        task_context.set({
+            'task_id': TaskManager._encrypt_task_id(task_id),
+            'batch_id': batch_id,
+            'profile': TaskManager._encrypt_profile_name(profile['name'])
+        })
+        Tracer.start_trace()
+        TaskManager.start_task(task_id)
+        
+        try:
+            with Tracer.span('task'):
+                # Get access token for this profile
+                with Tracer.span('token'):
+                    access_token = await cls.acquire_access_token(
+                        profile['refresh_token'],
+                        profile['client_id'],
+                        profile['client_secret'],
+                        profile['name']
+                    )
+                
+                results = await cls.sweep_endpoints(access_token, task_id, profile['name'])
+                TaskManager.record_results(task_id, results)
+                
+                TaskManager.finish_task(task_id, True)
+                # Upload log file to OneDrive after successful completion, once per batch unless uploading per profile
+                if cls.upload_logs and (
+                    LOG_UPLOAD_MODE == 'profile' or not batch_id or not TaskManager.get_batch_pending_count(batch_id)
+                ):
+                    with Tracer.span('upload'):
+                        await cls.upload_log_to_onedrive(access_token, profile['name'])
+        except asyncio.CancelledError:
+            TaskManager.cancel_task(task_id)
+            raise
+        except Exception as e:
+            TaskManager.finish_task(task_id, False, str(e))
+            raise
+    
+    @classmethod
+    async def upload_log_to_onedrive(cls, access_token: str, profile_name: str = None):
+        """Upload the part of the log file that was not shipped yet to OneDrive"""
+        try:
+            log_file_path = LOG_FILE
+            
+            # Check if log file exists
+            if not os.path.exists(log_file_path):
+                return
+
+            # Batch mode ships one shared tail, profile mode tracks an offset per account
+            upload_key = 'batch' if LOG_UPLOAD_MODE == 'batch' else TaskManager._encrypt_profile_name(profile_name or 'default')
+
+            async with LogUploader.get_lock(upload_key):
+                start, end, inode = LogUploader.get_pending_range(upload_key, log_file_path)
+                if end <= start:
+                    return
+
+                # Generate unique filename with timestamp
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                profile_suffix = f"_{TaskManager._encrypt_profile_name(profile_name)}" if profile_name else ""
+                remote_filename = f"e5-renewal-log_{timestamp}{profile_suffix}_{start}-{end}.txt"
+                headers = {'Authorization': f'Bearer {access_token}'}
+                started = time.perf_counter()
+
+                if end - start <= LogUploader.simple_upload_limit:
+                    file_content = await asyncio.to_thread(LogUploader.read_range, log_file_path, start, end - start)
+                    upload_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/logs/{remote_filename}:/content"
+                    response = await cls.upload_instance.put(
+                        upload_url, headers={**headers, 'Content-Type': 'text/plain'}, content=file_content
+                    )
+                    uploaded = response.status_code in (200, 201)
+                else:
+                    uploaded = await cls._upload_in_session(headers, remote_filename, log_file_path, start, end)
+                Metrics.observe_upload(time.perf_counter() - started)
+
+                if uploaded:
+                    await LogUploader.mark_uploaded(upload_key, end, inode)
+                    print(f"Log file uploaded to OneDrive: {remote_filename}")
+                else:
+                    print(f"Failed to upload log file: {remote_filename}")
+                
+        except Exception as e:
+            # Don't let upload errors affect main task
+            print(f"Error uploading log to OneDrive: {str(e)}")
+
+    @classmethod
+    async def _upload_in_session(cls, headers: dict, remote_filename: str, log_file_path: str, start: int, end: int):
+        """Stream a byte range of the log through a Graph upload session, one chunk in memory at a time"""
+        session_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/logs/{remote_filename}:/createUploadSession"
+        response = await cls.upload_instance.post(
+            session_url, headers=headers, json={'item': {'@microsoft.graph.conflictBehavior': 'rename'}}
+        )
+        upload_url = response.json().get('uploadUrl')
+        if not upload_url:
+            return False
+
+        total_size = end - start
+        for chunk_start in range(start, end, LogUploader.chunk_size):
+            chunk = await asyncio.to_thread(
+                LogUploader.read_range, log_file_path, chunk_start, min(LogUploader.chunk_size, end - chunk_start)
+            )
+            first_byte = chunk_start - start
+            # The upload URL is pre-authenticated, sending the bearer token to it is rejected
+            response = await cls.upload_instance.put(
+                upload_url,
+                headers={'Content-Range': f'bytes {first_byte}-{first_byte + len(chunk) - 1}/{total_size}'},
+                content=chunk
+            )
+            if response.status_code not in (200, 201, 202):
+                await cls.upload_instance.delete(upload_url)
+                return False
+
+        return response.status_code in (200, 201)
+
+class ShardRunner:
+    _executor = None
+    _log_queue = None
+    _log_listener = None
+    _batches = set()
+    _running_shards = 0
+    _stats = {
+        'batches': 0, 'shards_completed': 0, 'shards_failed': 0, 'completed': 0, 'failed': 0,
+        'retries': 0, 'gave_up': 0, 'token_hits': 0, 'token_misses': 0, 'token_refreshes': 0
+    }
+
+    @classmethod
+    def get_shard_index(cls, profile_name: str) -> int:
+        """Stable across restarts, so a profile keeps its shard and the shard's token cache file"""
+        return int(hashlib.md5(profile_name.encode()).hexdigest(), 16) % SHARD_COUNT
+
+    @classmethod
+    def partition(cls, profiles: list) -> dict:
+        shards = {}
+        for profile in profiles:
+            shards.setdefault(cls.get_shard_index(profile['name']), []).append(profile)
+        return shards
+
+    @classmethod
+    def _get_executor(cls):
+        if cls._executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            from logging_pipeline import listen_forwarded
+            # Spawned rather than forked, the parent holds an event loop, sqlite handles and logging threads
+            context = multiprocessing.get_context('spawn')
+            cls._log_queue = context.Queue()
+            cls._log_listener = listen_forwarded(cls._log_queue)
+            cls._executor = ProcessPoolExecutor(
+                max_workers=SHARD_COUNT,
+                mp_context=context,
+                initializer=cls._init_process,
+                initargs=(cls._log_queue,)
+            )
+        return cls._executor
+
+    @classmethod
+    def _init_process(cls, log_queue):
+        from logging_pipeline import forward_to_queue
+        forward_to_queue(log_queue, LOGGER_CONFIG_JSON['loggers'])
+
+    @classmethod
+    def _run_shard(cls, shard_index: int, profiles: list, batch_id: str) -> dict:
+        """Entry point of a shard process, sweeps its profiles on a private event loop"""
+        TokenCache.use_file(f"{TOKEN_CACHE_FILE}.shard{shard_index}")
+        EndpointPlanner.use_file(f"{ENDPOINT_PLAN_FILE}.shard{shard_index}")
+        # Only one shard ships logs so the shared upload offsets have a single writer
+        HTTPClient.upload_logs = UPLOAD_LOGS_TO_ONEDRIVE and shard_index == 0
+        HTTPClient.reopen()
+        for key in RetryPolicy._stats:
+            RetryPolicy._stats[key] = 0
+        for key in TokenCache._stats:
+            TokenCache._stats[key] = 0
+        # Worker processes are reused and every shard runs on a new event loop, asyncio primitives left by
+        # the previous shard are bound to its loop and fail with "bound to a different event loop"
+        TokenCache._flush_task = None
+        EndpointPlanner._flush_task = None
+        LogUploader._locks = {}
+        LogIndex._lock = None
+
+        summary = asyncio.run(CLIRunner.run(profiles, batch_id))
+        return {**summary, 'shard': shard_index, 'retries': RetryPolicy.get_stats()}
+
+    @classmethod
+    async def run_batch(cls, batch_id: str, profiles: list) -> dict:
+        """Sweep already queued profile tasks across the shard processes and merge their outcome"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        shards = cls.partition(profiles)
+        executor = cls._get_executor()
+        cls._stats['batches'] += 1
+        cls._running_shards += len(shards)
+
+        async def run_shard(shard_index: int, shard_profiles: list) -> dict:
+            try:
+                summary = await loop.run_in_executor(executor, cls._run_shard, shard_index, shard_profiles, batch_id)
+            except Exception as e:
+                getLogger('uvicorn').error(f'Shard {shard_index} failed: {e}')
+                cls._stats['shards_failed'] += 1
+                summary = {
+                    'shard': shard_index,
+                    'profiles_count': len(shard_profiles),
+                    'completed': 0,
+                    'failed': len(shard_profiles),
+                    'tasks': [],
+                    'error': str(e)
+                }
+                for profile in shard_profiles:
+                    TaskManager._close_task(f"{batch_id}-{profile['name']}", 'failed', str(e))
+            except asyncio.CancelledError:
+                # Shutdown grace period ran out, the shard process may still finish and overwrite this
+                for profile in shard_profiles:
+                    TaskManager._close_task(f"{batch_id}-{profile['name']}", 'cancelled', 'Server shutting down')
+                raise
+            else:
+                cls._merge(summary)
+                # Shards report hashed task ids, single-flight bookkeeping is keyed by the raw ones
+                task_ids = {
+                    TaskManager._encrypt_task_id(f"{batch_id}-{profile['name']}"): f"{batch_id}-{profile['name']}"
+                    for profile in shard_profiles
+                }
+                for task in summary['tasks']:
+                    TaskManager.resolve_shard_task(task_ids.get(task['task_id'], task['task_id']), task['status'])
+            finally:
+                cls._running_shards -= 1
+            return summary
+
+        try:
+            results = await gather(*(run_shard(index, shard) for index, shard in sorted(shards.items())))
+        finally:
+            if not TaskManager.is_busy():
+                TaskEvents.publish({'status': 'idle', 'timestamp': datetime.now().isoformat()})
+
+        completed = sum(result['completed'] for result in results)
+        return {
+            'batch_id': batch_id,
+            'profiles_count': len(profiles),
+            'completed': completed,
+            'failed': len(profiles) - completed,
+            'duration_seconds': round(time.perf_counter() - started, 3),
+            'shards': [
+                {key: result.get(key) for key in ('shard', 'profiles_count', 'completed', 'failed', 'duration_seconds')}
+                for result in results
+            ],
+            'tasks': [task for result in results for task in result['tasks']]
+        }
+
+    @classmethod
+    def submit_batch(cls, batch_id: str, profiles: list):
+        """Run a queued batch in the background, used by /call-all-profiles"""
+        task = asyncio.create_task(cls.run_batch(batch_id, profiles))
+        cls._batches.add(task)
+        task.add_done_callback(cls._batches.discard)
+
+    @classmethod
+    def _merge(cls, summary: dict):
+        token_cache = summary.get('token_cache', {})
+        cls._stats['shards_completed'] += 1
+        cls._stats['completed'] += summary['completed']
+        cls._stats['failed'] += summary['failed']
+        cls._stats['retries'] += summary['retries']['retries']
+        cls._stats['gave_up'] += summary['retries']['gave_up']
+        cls._stats['token_hits'] += token_cache.get('hits', 0)
+        cls._stats['token_misses'] += token_cache.get('misses', 0)
+        cls._stats['token_refreshes'] += token_cache.get('refreshes', 0)
+
+    @classmethod
+    async def stop(cls, grace_period: float = None):
+        pending = set()
+        if cls._batches:
+            _, pending = await asyncio.wait(set(cls._batches), timeout=grace_period)
+            for batch in pending:
+                batch.cancel()
+            await gather(*pending, return_exceptions=True)
+        if cls._executor is not None:
+            # Shards that are still sweeping after the grace period are not waited for
+            await asyncio.to_thread(cls._executor.shutdown, wait=not pending, cancel_futures=True)
+            cls._executor = None
+        if cls._log_listener is not None:
+            cls._log_listener.stop()
+            cls._log_listener = None
+
+    @classmethod
+    def get_running_count(cls) -> int:
+        return cls._running_shards
+
+    @classmethod
+    def get_stats(cls):
+        return {**cls._stats, 'shard_count': SHARD_COUNT, 'running_shards': cls._running_shards}
+
+class CLIRunner:
+    @classmethod
+    async def run(cls, profiles: list, batch_id: str = None) -> dict:
+        """Sweep the given profiles once through the worker pool and summarize the outcome"""
+        import uuid
+        started = time.perf_counter()
+        first_request = {}
+
+        async def record_first_request(_):
+            first_request.setdefault('at', time.perf_counter())
+
+        HTTPClient.instance.event_hooks['request'].append(record_first_request)
+        batch_id = batch_id or str(uuid.uuid4())[:8]
+        task_ids = [f"{batch_id}-{profile['name']}" for profile in profiles]
+
+        # A run queues all of its profiles at once, the queue limit only guards the web server's backlog
+        WorkerPool.start(queue_size=max(JOB_QUEUE_SIZE, len(profiles)))
+        try:
+            for profile, task_id in zip(profiles, task_ids):
+                TaskManager.queue_task(task_id)
+                if not WorkerPool.submit(HTTPClient.call_endpoints_for_profile, profile, task_id):
+                    TaskManager._close_task(task_id, 'failed', 'Job queue is full')
+            await WorkerPool.join()
+        finally:
+            await WorkerPool.stop()
+            await TokenCache.flush()
+            await EndpointPlanner.flush()
+            await HTTPClient.close()
+
+        # Shards share the database, so only report the tasks of this run
+        statuses = {}
+        for task_id in task_ids:
+            task = TaskStore.get_task(TaskManager._encrypt_task_id(task_id), 0, 0) or {}
+            statuses[TaskManager._encrypt_task_id(task_id)] = task.get('status', 'failed')
+        TaskStore.close()
+        completed = sum(1 for status in statuses.values() if status == 'completed')
+        return {
+            'batch_id': batch_id,
+            'profiles_count': len(profiles),
+            'completed': completed,
+            'failed': len(profiles) - completed,
+            'duration_seconds': round(time.perf_counter() - started, 3),
+            'time_to_first_request_ms': (
+                round((first_request['at'] - PROCESS_STARTED) * 1000, 1) if first_request else None
+            ),
+            'tasks': [{'task_id': task_id, 'status': status} for task_id, status in statuses.items()],
+            'token_cache': TokenCache.get_stats()
+        }
+
+    @classmethod
+    async def run_sharded(cls, profiles: list) -> dict:
+        import uuid
+        batch_id = str(uuid.uuid4())[:8]
+        for profile in profiles:
+            TaskManager.queue_task(f"{batch_id}-{profile['name']}")
+        try:
+            return await ShardRunner.run_batch(batch_id, profiles)
+        finally:
+            await ShardRunner.stop()
+            TaskStore.close()
+
+    @classmethod
+    def main(cls, profile_names: list) -> int:
+        from logging.config import dictConfig
+        dictConfig(LOGGER_CONFIG_JSON)
+
+        profiles = ProfileStore.get_enabled()
+        if not profiles:
+            print(json.dumps({'error': 'No profiles configured. Please add profiles to profiles.json'}))
+            return 2
+
+        if profile_names:
+            profiles = [profile for profile in map(ProfileStore.get, profile_names) if profile and profile.get('enabled', True)]
+        if SHARD_COUNT > 1:
+            summary = asyncio.run(cls.run_sharded(profiles))
+        else:
+            summary = asyncio.run(cls.run(profiles))
+        print(json.dumps(summary, indent=2))
+        return 0 if summary['profiles_count'] and not summary['failed'] else 1
+
+Metrics.preallocate(HTTPClient.graph_endpoints)
+
+def __getattr__(name: str):
+    # uvicorn resolves "main:web_server" through this, building the app on first access
+    if name == 'web_server':
+        global web_server
+        web_server = WebServer().instance
+        return web_server
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        sys.exit(CLIRunner.main(sys.argv[2:]))
+
+    from uvicorn import run
     run(
         app="main:web_server",
         host=WEB_APP_HOST,
@@ -0,0 +1,141 @@
+from uvicorn import run
+from quart import Quart, request
+from argparse import ArgumentParser
+from asyncio import sleep as async_sleep
+from base64 import urlsafe_b64encode
+from random import expovariate, random
+from logging import getLogger
+from config import LOGGER_CONFIG_JSON
+import hashlib
+import json
+
+"""
+Local stand-in for Microsoft Graph used to exercise the renewal flow offline.
+Point E5_GRAPH_BATCH_BASE_URL at this server to verify JSON batching without a real tenant,
+or E5_UPSTREAM_BASE_URL to send every login.microsoftonline.com, graph.microsoft.com and
+api.powerbi.com request here (see benchmark.py).
+"""
+
+class WebServer:
+    instance = Quart(__name__)
+    stats = {
+        'batchRequests': 0, 'subRequests': 0, 'directRequests': 0,
+        'tokenRequests': 0, 'throttled': 0, 'errors': 0
+    }
+    # Mean response latency and the share of API calls answered with 5xx or 429, set from the command line
+    options = {'latency_ms': 0.0, 'error_rate': 0.0, 'throttle_rate': 0.0, 'retry_after': 1}
+
+    def __init__(self):
+        self.logger = getLogger('uvicorn')
+
+        @self.instance.before_serving
+        async def before_serve():
+            self.logger.info(f'Mock Graph server is running ({self.options})')
+
+        RouteHandler(self.instance)
+
+    @classmethod
+    async def delay(cls):
+        if cls.options['latency_ms']:
+            await async_sleep(expovariate(1000 / cls.options['latency_ms']))
+
+    @classmethod
+    def pick_failure(cls):
+        """Status code of a simulated failure, or None when the call should succeed"""
+        roll = random()
+        if roll < cls.options['throttle_rate']:
+            cls.stats['throttled'] += 1
+            return 429
+        if roll < cls.options['throttle_rate'] + cls.options['error_rate']:
+            cls.stats['errors'] += 1
+            return 503
+        return None
+
+class RouteHandler:
+    def __init__(self, instance: Quart):
+
+        @instance.route('/stats')
+        async def stats():
+            return WebServer.stats, 200
+
+        @instance.route('/<tenant>/oauth2/v2.0/token', methods=['POST'])
+        async def token(tenant: str):
+            form = await request.form
+            if not form.get('refresh_token') or not form.get('client_id'):
+                return {'error': 'invalid_grant'}, 400
+
+            WebServer.stats['tokenRequests'] += 1
+            await WebServer.delay()
+            # Unsigned JWT carrying a tenant id derived from the app, enough for code that reads claims
+            encode = lambda part: urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip('=')
+            claims = {'tid': hashlib.md5(form['client_id'].encode()).hexdigest(), 'aud': 'https://graph.microsoft.com'}
+            return {
+                'token_type': 'Bearer',
+                'expires_in': 3600,
+                'access_token': f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(claims)}.",
+                'refresh_token': form['refresh_token']
+            }, 200
+
+        @instance.route('/<version>/$batch', methods=['POST'])
+        async def batch(version: str):
+            json_data = await request.get_json(silent=True) or {}
+            sub_requests = json_data.get('requests', [])
+
+            if not request.headers.get('Authorization'):
+                return {'error': {'code': 'InvalidAuthenticationToken'}}, 401
+            if not sub_requests or len(sub_requests) > 20:
+                return {'error': {'code': 'BadRequest', 'message': 'A batch must contain 1 to 20 requests.'}}, 400
+
+            WebServer.stats['batchRequests'] += 1
+            WebServer.stats['subRequests'] += len(sub_requests)
+            await WebServer.delay()
+            responses = []
+            for sub_request in sub_requests:
+                failure = WebServer.pick_failure()
+                responses.append({
+                    'id': sub_request.get('id'),
+                    'status': failure or (200 if sub_request.get('method') == 'GET' else 405),
+                    'headers': (
+                        {'Retry-After': str(WebServer.options['retry_after'])} if failure == 429
+                        else {'Content-Type': 'application/json'}
+                    ),
+                    'body': {'@odata.context': f"https://graph.microsoft.com/{version}{sub_request.get('url')}"}
+                })
+            return {'responses': responses}, 200
+
+        @instance.route('/<path:path>', methods=['GET'])
+        async def direct(path: str):
+            WebServer.stats['directRequests'] += 1
+            await WebServer.delay()
+            failure = WebServer.pick_failure()
+            if failure == 429:
+                return {'error': {'code': 'TooManyRequests'}}, 429, {'Retry-After': str(WebServer.options['retry_after'])}
+            if failure:
+                return {'error': {'code': 'ServiceUnavailable'}}, failure
+            return {'@odata.context': f'https://graph.microsoft.com/{path}'}, 200
+
+web_server = WebServer().instance
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Mock Microsoft login, Graph and Power BI server')
+    parser.add_argument('port', nargs='?', type=int, default=9998)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='mean response latency (exponentially distributed)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429 answers')
+    arguments = parser.parse_args()
+    WebServer.options.update(
+        latency_ms=arguments.latency_ms,
+        error_rate=arguments.error_rate,
+        throttle_rate=arguments.throttle_rate,
+        retry_after=arguments.retry_after
+    )
+
+    # Served by object, importing the module again by name would drop the options set above
+    run(
+        app=web_server,
+        host='127.0.0.1',
+        port=arguments.port,
+        log_config=LOGGER_CONFIG_JSON,
+        access_log=False
+    )
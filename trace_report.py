@@ -0,0 +1,110 @@
+from argparse import ArgumentParser
+from statistics import quantiles
+import gzip
+import json
+import sys
+
+"""
+Per-stage time breakdown of a trace written with E5_TRACE_ENABLED=true.
+Reads the JSON-lines trace file (rotated .gz files too) and shows where the time of the traced
+tasks went: token exchange, rate limit waits, endpoint calls, $batch requests, connection setup
+and log uploads. Connection setup happens inside token and endpoint calls and is not added to "other".
+
+    python trace_report.py trace.jsonl --batch 1a2b3c4d --by endpoint
+"""
+
+class TraceReport:
+    # Stages that follow each other inside a task span, the rest of the task time is reported as "other".
+    # Rate limit waits of retries run inside their endpoint or batch span and are not counted twice
+    sequential_stages = ['token', 'rate_limit', 'endpoint', 'batch', 'upload']
+
+    @classmethod
+    def read_spans(cls, paths: list, batch_id: str = None, task_id: str = None):
+        for path in paths:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash or rotation
+                        continue
+                    if batch_id and span.get('batch_id') != batch_id:
+                        continue
+                    if task_id and span.get('task_id') != task_id:
+                        continue
+                    yield span
+
+    @classmethod
+    def summarize(cls, durations: list) -> dict:
+        percentiles = quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+        return {
+            'count': len(durations),
+            'total_ms': round(sum(durations), 1),
+            'mean_ms': round(sum(durations) / len(durations), 1),
+            'p50_ms': round(percentiles[49], 1),
+            'p99_ms': round(percentiles[98], 1)
+        }
+
+    @classmethod
+    def build(cls, spans, group_by: str = 'span') -> dict:
+        durations = {}
+        errors = {}
+        tasks = set()
+        task_total = 0
+        stage_totals = {}
+        for span in spans:
+            if span['span'] == 'task':
+                tasks.add(span.get('task_id'))
+                task_total += span['duration_ms']
+            if not span.get('retry'):
+                stage_totals[span['span']] = stage_totals.get(span['span'], 0) + span['duration_ms']
+            key = span['span'] if group_by == 'span' else f"{span['span']} {span.get(group_by) or '-'}"
+            durations.setdefault(key, []).append(span['duration_ms'])
+            if span.get('error'):
+                errors[key] = errors.get(key, 0) + 1
+
+        stages = {}
+        for key, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            stages[key] = {**cls.summarize(values), 'errors': errors.get(key, 0)}
+            if task_total and not key.startswith('task'):
+                stages[key]['share'] = round(sum(values) / task_total * 100, 1)
+
+        if task_total and group_by == 'span':
+            other = task_total - sum(stage_totals.get(stage, 0) for stage in cls.sequential_stages)
+            stages['other'] = {'total_ms': round(other, 1), 'share': round(other / task_total * 100, 1)}
+        return {'tasks': len(tasks), 'task_time_ms': round(task_total, 1), 'stages': stages}
+
+    @classmethod
+    def print_table(cls, report: dict):
+        print(f"{report['tasks']} task(s), {report['task_time_ms']} ms task time")
+        print(f"{'stage':<60} {'count':>7} {'total ms':>12} {'share':>7} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        for key, stage in report['stages'].items():
+            share = f"{stage['share']}%" if 'share' in stage else '-'
+            print(
+                f"{key[:60]:<60} {stage.get('count', '-'):>7} {stage['total_ms']:>12} {share:>7} "
+                f"{stage.get('p50_ms', '-'):>9} {stage.get('p99_ms', '-'):>9} {stage.get('errors', '-'):>7}"
+            )
+
+    @classmethod
+    def main(cls):
+        parser = ArgumentParser(description='Per-stage time breakdown of an E5 renewal trace')
+        parser.add_argument('paths', nargs='+', help='trace files, rotated .gz files are read as well')
+        parser.add_argument('--batch', help='only spans of this batch id')
+        parser.add_argument('--task', help='only spans of this (hashed) task id')
+        parser.add_argument('--by', default='span', help='group by span name (default) or a span field such as endpoint')
+        parser.add_argument('--json', action='store_true', help='print the breakdown as JSON')
+        arguments = parser.parse_args()
+
+        report = cls.build(cls.read_spans(arguments.paths, arguments.batch, arguments.task), arguments.by)
+        if not report['stages']:
+            print('No spans found', file=sys.stderr)
+            return 1
+        if arguments.json:
+            print(json.dumps(report, indent=2))
+        else:
+            cls.print_table(report)
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(TraceReport.main())